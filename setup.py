@@ -17,6 +17,7 @@ setup(
     entry_points={
         "console_scripts": [
             "jatmo-server-test=jatmo.test_server:main",
+            "jatmo-bench-parse=jatmo.bench_parse_inputs:main",
             "jatmo-prompt-select=jatmo.prompt_injection_select.main:main",
             "jatmo-autogen=jatmo.example_tasks.auto_tasks.main:main",
             "jatmo-semiauto=jatmo.example_tasks.semiauto_tasks.main:main",
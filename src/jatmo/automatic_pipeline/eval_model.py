@@ -1,13 +1,26 @@
 import os
-import re
 
 import dill
 from tqdm import tqdm
 
-from ..server import init_servers, kill_servers, rate_completions
+from ..server import (
+    Dispatcher,
+    Rater,
+    RatingStore,
+    init_servers,
+    kill_servers,
+)
+from ..tools.classification import (
+    accuracy,
+    classification_kwargs,
+    decode_label,
+    label_max_tokens,
+)
 from ..tools.finetune import format_finetune_data
-from ..tools.output_generation import label_inputs
-from .utils import reformat_prompt
+from ..tools.metrics import reference_metrics, write_metrics
+from ..tools.output_generation import response_text, should_resample
+from .formatting import TemplateFormatter
+from .utils import reformat_prompt, strip_reformat_markers
 
 
 def compare_to_ft_model(
@@ -20,8 +33,48 @@ def compare_to_ft_model(
     redo_empty_responses=True,
     temperatures=None,
     no_formatting=False,
+    local_formatting=False,
+    calibration_size=5,
+    grading_mode="text",
+    rating_pack_size=1,
+    completion_batch_size=1,
+    labels=None,
+    label_decoding="text",
     **kwargs,
 ):
+    """
+    Compare fine-tuned models to the teacher on external inputs.
+
+    The inputs are first reformatted to the training format. Outputs of the
+    teacher and of each model are then generated at each temperature and
+    rated by the grader. With a label set, outputs are instead generated
+    with just enough tokens for the longest label, decoded to the label set,
+    and each model is scored by its exact-match accuracy against the
+    teacher's labels, see eval_labels.
+
+    Args:
+        path (str): The run directory.
+        inputs (List[str]): The external inputs.
+        example (str): The example of the training format.
+        model_ids (List[str]): The fine-tuned models.
+        task (str): The task description.
+        parallelism (int, optional): Number of servers. Defaults to 8.
+        redo_empty_responses (bool, optional): Request empty outputs again. Defaults to True.
+        temperatures (List[float], optional): The generation temperatures. Defaults to [1.0].
+        no_formatting (bool, optional): Use the inputs as they are. Defaults to False.
+        local_formatting (bool, optional): Format matching inputs locally, see format_inputs. Defaults to False.
+        calibration_size (int, optional): Number of inputs formatted by the LLM before inferring the layout. Defaults to 5.
+        grading_mode (str, optional): The rating mode, see Rater. Defaults to "text".
+        rating_pack_size (int, optional): Number of outputs rated per grader request. Defaults to 1.
+        completion_batch_size (int, optional): Number of fine-tuned model prompts sent per call. Defaults to 1.
+        labels (List[str], optional): The label set of a classification task. Defaults to None.
+        label_decoding (str, optional): "text" or "logprob", see decode_label. Defaults to "text".
+        **kwargs: Additional keyword arguments for call_openai.
+
+    Returns:
+        Dict[float, Dict[str, float]]: The average rating of the teacher ("GPT") and of each model per
+            temperature. With a label set, the accuracy of each model.
+    """
     if isinstance(model_ids, str):
         model_ids = [model_ids]
 
@@ -51,37 +104,75 @@ def compare_to_ft_model(
         kwargs_reformat["timeout"] = 60
 
         formatted_inputs = ["" for _ in inputs]
-        prompt_inputs = [reformat_prompt(example, input) for input in inputs]
-        for i, ipt in enumerate(prompt_inputs):
+
+        def store(p_idx, resp):
+            try:
+                resp_text = strip_reformat_markers(
+                    resp.choices[0].message.content
+                )
+            except AttributeError:
+                return None
+            formatted_inputs[p_idx] = format_finetune_data([resp_text], [""])[
+                0
+            ]["prompt"]
+            if p_idx % 20 == 0:
+                print(formatted_inputs[p_idx])
+            return resp_text
+
+        pending = list(range(len(inputs)))
+        pbar = tqdm(total=len(inputs), desc="Reformatting inputs")
+
+        if local_formatting:
+            formatter = TemplateFormatter(
+                example, min_observations=min(calibration_size, len(inputs))
+            )
+            calibration, pending = (
+                pending[:calibration_size],
+                pending[calibration_size:],
+            )
+            for i in calibration:
+                queue.put(
+                    (
+                        i,
+                        reformat_prompt(example, inputs[i]),
+                        4096,
+                        kwargs_reformat,
+                        resp_queue,
+                    )
+                )
+
+            for _ in calibration:
+                p_idx, resp = resp_queue.get(block=True)
+                pbar.update(1)
+                formatter.observe(inputs[p_idx], store(p_idx, resp))
+
+            remaining = []
+            for i in pending:
+                local = formatter.format(inputs[i])
+                if local is None:
+                    remaining.append(i)
+                    continue
+                formatted_inputs[i] = format_finetune_data([local], [""])[0][
+                    "prompt"
+                ]
+                pbar.update(1)
+            pending = remaining
+
+        for i in pending:
             queue.put(
                 (
                     i,
-                    ipt,
+                    reformat_prompt(example, inputs[i]),
                     4096,
                     kwargs_reformat,
                     resp_queue,
                 )
             )
 
-        for _ in tqdm(
-            inputs,
-            total=len(inputs),
-            desc="Reformatting inputs",
-        ):
+        for _ in pending:
             p_idx, resp = resp_queue.get(block=True)
-            try:
-                resp_text = re.sub(
-                    r"([\s\n\t]*START)|(END[\s\n\t]*)",
-                    "",
-                    resp.choices[0].message.content,
-                ).strip()
-                formatted_inputs[p_idx] = format_finetune_data(
-                    [resp_text], [""]
-                )[0]["prompt"]
-                if p_idx % 20 == 0:
-                    print(formatted_inputs[p_idx])
-            except AttributeError:
-                continue
+            pbar.update(1)
+            store(p_idx, resp)
 
         FT_inputs = [f + " " for f in formatted_inputs]
         GPT_inputs = [task + "\n###\n" + f for f in FT_inputs]
@@ -97,48 +188,114 @@ def compare_to_ft_model(
     if temperatures is None:
         temperatures = [1.0]
 
-    for temp in temperatures:
-        kwargs["temperature"] = temp
-        # Generate GPT Outputs
-        orig_kwargs["model"] = "mistralai/Mixtral-8x7B-Instruct-v0.1"
-        orig_kwargs["temperature"] = temp
-        GPT_outputs = label_inputs(
-            GPT_inputs,
-            max_tokens=512,
-            force=redo_empty_responses,
-            **orig_kwargs,
+    # Generate outputs for every (temperature, model, input) and rate them on
+    # a single pool. Each output is sent for rating as soon as it is generated.
+    dispatcher = Dispatcher(parallelism, batch_size=completion_batch_size)
+    rater = (
+        None
+        if labels
+        else Rater(
+            dispatcher,
+            store=RatingStore(path),
+            mode=grading_mode,
+            pack_size=rating_pack_size,
         )
+    )
+    outputs_per_temp = {
+        temp: {m: ["" for _ in FT_inputs] for m in ["GPT"] + model_ids}
+        for temp in temperatures
+    }
+    predictions_per_temp = {
+        temp: {m: [None for _ in FT_inputs] for m in ["GPT"] + model_ids}
+        for temp in temperatures
+    }
+    max_tokens = label_max_tokens(labels) if labels else 512
+    kwargs_per_model = {}
 
-        # Generate FT outputs
-        outputs = {m: ["" for _ in FT_inputs] for m in model_ids}
+    for temp in temperatures:
+        # GPT outputs
+        gpt_kwargs = orig_kwargs.copy()
+        gpt_kwargs["model"] = "mistralai/Mixtral-8x7B-Instruct-v0.1"
+        gpt_kwargs["temperature"] = temp
+        if "timeout" not in gpt_kwargs:
+            gpt_kwargs["timeout"] = 30
+        kwargs_per_model[(temp, "GPT")] = gpt_kwargs
+
+        # FT outputs
         for model in model_ids:
-            kwargs["query_type"] = "completion"
-            kwargs["stop"] = ["###"]
-            kwargs["model"] = model
-            kwargs["timeout"] = 30
-
-            outputs[model] = label_inputs(
-                FT_inputs,
-                max_tokens=512,
-                force=redo_empty_responses,
-                **kwargs,
+            ft_kwargs = kwargs.copy()
+            ft_kwargs["temperature"] = temp
+            ft_kwargs["query_type"] = "completion"
+            ft_kwargs["stop"] = ["###"]
+            ft_kwargs["model"] = model
+            ft_kwargs["timeout"] = 30
+            kwargs_per_model[(temp, model)] = ft_kwargs
+
+        if labels:
+            for model in ["GPT"] + model_ids:
+                kwargs_per_model[(temp, model)] = classification_kwargs(
+                    labels, label_decoding, **kwargs_per_model[(temp, model)]
+                )
+
+        for model in ["GPT"] + model_ids:
+            model_inputs = GPT_inputs if model == "GPT" else FT_inputs
+            for i, ipt in enumerate(model_inputs):
+                dispatcher.submit(
+                    "generate",
+                    (temp, model, i),
+                    ipt,
+                    max_tokens,
+                    kwargs_per_model[(temp, model)],
+                )
+
+    pbar = tqdm(
+        total=dispatcher.pending(),
+        desc="Generating labels" if labels else "Rating outputs",
+    )
+    while dispatcher.pending() or (rater is not None and rater.flush()):
+        stage, key, resp = dispatcher.get()
+        if stage != "generate":
+            pbar.update(len(rater.handle(key, resp)))
+            continue
+
+        temp, model, i = key
+        model_kwargs = kwargs_per_model[(temp, model)]
+        query_type = (
+            model_kwargs["query_type"] if "query_type" in model_kwargs else "chat"
+        )
+        text = response_text(resp, query_type)
+        if labels:
+            outputs_per_temp[temp][model][i] = text
+            predictions_per_temp[temp][model][i] = decode_label(
+                resp, labels, query_type, label_decoding
             )
+            pbar.update(1)
+            continue
 
-        # Rate completions
-        prompts = GPT_inputs[:]
-        responses = GPT_outputs[:]
+        if should_resample(resp, text, redo_empty_responses):
+            local_kwargs = model_kwargs.copy()
+            local_kwargs["n"] = 10
+            dispatcher.submit(
+                "generate",
+                key,
+                GPT_inputs[i] if model == "GPT" else FT_inputs[i],
+                512,
+                local_kwargs,
+            )
+            continue
 
-        for model in model_ids:
-            prompts += GPT_inputs[:]
-            responses += outputs[model][:]
+        outputs_per_temp[temp][model][i] = text
+        pbar.update(len(rater.submit(key, GPT_inputs[i], text)))
 
-        with open(os.path.join(path, f"save_{temp}.pkl"), "wb") as outfile:
-            dill.dump((GPT_outputs, outputs), outfile)
+    dispatcher.close()
+    pbar.close()
 
-        queue, manager = init_servers(parallelism)
-        resp_queue = manager.Queue()
+    for temp in temperatures:
+        GPT_outputs = outputs_per_temp[temp]["GPT"]
+        outputs = {m: outputs_per_temp[temp][m] for m in model_ids}
 
-        ratings = rate_completions(prompts, responses, queue, resp_queue)
+        with open(os.path.join(path, f"save_{temp}.pkl"), "wb") as outfile:
+            dill.dump((GPT_outputs, outputs), outfile)
 
         with open(
             path + f"/eval_ft_compare_outputs_{temp}.pkl", "wb"
@@ -147,6 +304,33 @@ def compare_to_ft_model(
                 (inputs, FT_inputs, GPT_inputs, GPT_outputs, outputs), outfile
             )
 
+        if labels:
+            predictions = predictions_per_temp[temp]
+            with open(
+                path + f"/eval_ratings_{temp}.tsv", "w", encoding="utf-8"
+            ) as outfile:
+                outfile.write("index\treference\t" + "\t".join(model_ids) + "\n")
+                for i, reference in enumerate(predictions["GPT"]):
+                    outfile.write(
+                        f"{i}\t{reference}\t"
+                        + "\t".join(
+                            str(int(predictions[m][i] == reference))
+                            for m in model_ids
+                        )
+                        + "\n"
+                    )
+            rtn[temp] = {
+                m: accuracy(predictions[m], predictions["GPT"])
+                for m in model_ids
+            }
+            continue
+
+        ratings = [
+            rater.ratings[(temp, m, i)]
+            for m in ["GPT"] + model_ids
+            for i, _ in enumerate(inputs)
+        ]
+
         with open(
             path + f"/eval_ratings_{temp}.tsv", "w", encoding="utf-8"
         ) as outfile:
@@ -162,11 +346,19 @@ def compare_to_ft_model(
                 )
                 outfile.write(line)
 
+        write_metrics(
+            path,
+            {
+                m: reference_metrics(outputs[m], GPT_outputs)
+                for m in model_ids
+            },
+            filename=f"eval_metrics_{temp}.tsv",
+        )
+
         rtn[temp] = {
             m: sum(ratings[j * len(inputs) : (j + 1) * len(inputs)])
             / len(inputs)
             for j, m in enumerate(["GPT"] + model_ids)
         }
 
-    kill_servers()
     return rtn
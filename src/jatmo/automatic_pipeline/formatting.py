@@ -0,0 +1,154 @@
+""" Local inference of the input layout used by the reformatting prompt. """
+from __future__ import annotations
+
+import re
+
+SEPARATOR = "###"
+MISSING_FIELD = "N/A"
+
+
+def split_fields(text, separator=SEPARATOR):
+    """
+    Split a formatted input into its separator-delimited fields.
+
+    Args:
+        text (str): The formatted input.
+        separator (str, optional): The field separator. Defaults to "###".
+
+    Returns:
+        List[str]: The stripped, non-empty fields.
+    """
+    return [f.strip() for f in str(text).split(separator) if f.strip()]
+
+
+def _normalize(field):
+    return " ".join(field.split()).strip("\"'")
+
+
+def _split_identity(raw):
+    return [raw.strip()] if raw.strip() else []
+
+
+def _split_separator(raw):
+    return split_fields(raw)
+
+
+def _split_paragraphs(raw):
+    return [f.strip() for f in re.split(r"\n\s*\n", raw) if f.strip()]
+
+
+def _split_lines(raw):
+    return [f.strip() for f in raw.split("\n") if f.strip()]
+
+
+# Candidate rules, from the least to the most aggressive split.
+SPLIT_RULES = {
+    "identity": _split_identity,
+    "separator": _split_separator,
+    "paragraphs": _split_paragraphs,
+    "lines": _split_lines,
+}
+
+
+class TemplateFormatter:
+    """
+    Learns how raw inputs map onto the layout of a formatted example.
+
+    The formatter looks at the example and at a few (raw, formatted) pairs
+    produced by the LLM, and picks the simplest splitting rule that
+    reproduces the LLM output. Once a rule is known, inputs that split into
+    the expected number of fields are formatted locally; everything else is
+    left for the LLM.
+
+    Args:
+        example (str): The formatted example input.
+        min_observations (int, optional): Number of LLM-formatted inputs to
+            observe before inferring a rule. Defaults to 5.
+        min_agreement (float, optional): Fraction of the observations a rule
+            must reproduce to be used. Defaults to 0.8.
+    """
+
+    def __init__(self, example, min_observations=5, min_agreement=0.8):
+        self.example_fields = split_fields(example) if example else []
+        self.min_observations = min_observations
+        self.min_agreement = min_agreement
+        self.observations = []
+        self.rule = None
+        self.field_count = None
+        self.pad_missing = False
+
+    @property
+    def ready(self):
+        return len(self.observations) >= self.min_observations
+
+    def observe(self, raw, formatted):
+        """
+        Record an input formatted by the LLM and refresh the inferred rule.
+
+        Args:
+            raw (str): The unformatted input.
+            formatted (str): The LLM output, with START/END markers removed.
+        """
+        if not raw or not formatted:
+            return
+        self.observations.append((raw, split_fields(formatted)))
+        if self.ready:
+            self._infer_rule()
+
+    def _explains(self, fields, observed):
+        if len(fields) > len(observed):
+            return False, False
+        padded = len(fields) < len(observed)
+        if padded and any(f != MISSING_FIELD for f in observed[len(fields) :]):
+            return False, False
+        return (
+            all(
+                _normalize(f) == _normalize(o) for f, o in zip(fields, observed)
+            ),
+            padded,
+        )
+
+    def _infer_rule(self):
+        self.rule = None
+        for name, split in SPLIT_RULES.items():
+            matches, padded, counts = 0, False, {}
+            for raw, observed in self.observations:
+                ok, pad = self._explains(split(raw), observed)
+                if ok:
+                    matches += 1
+                    padded = padded or pad
+                    counts[len(observed)] = counts.get(len(observed), 0) + 1
+
+            if matches >= self.min_agreement * len(self.observations):
+                self.rule = name
+                self.field_count = (
+                    len(self.example_fields)
+                    if len(self.example_fields) in counts
+                    else max(counts, key=counts.get)
+                )
+                self.pad_missing = padded
+                return
+
+    def format(self, raw):
+        """
+        Format an input locally using the inferred rule.
+
+        Args:
+            raw (str): The unformatted input.
+
+        Returns:
+            str or None: The formatted input, with fields separated by
+            "\\n###\\n", or None if the input cannot be matched confidently.
+        """
+        if self.rule is None or not raw:
+            return None
+
+        fields = SPLIT_RULES[self.rule](str(raw))
+        if not fields:
+            return None
+        if len(fields) < self.field_count and self.pad_missing:
+            fields += [MISSING_FIELD] * (self.field_count - len(fields))
+        if len(fields) != self.field_count:
+            return None
+
+        return ("\n" + SEPARATOR + "\n").join(fields)
@@ -11,19 +11,19 @@ Example tasks:
 
 import math
 import random
-import re
 import string
-import json
-import os
 
 from tqdm import tqdm
 
 from ..server import init_servers, kill_servers
+from .formatting import TemplateFormatter
 from .utils import (
     get_formatting_input,
     get_generation_prompt,
+    layout_formatted_input,
     parse_inputs,
     reformat_prompt,
+    strip_reformat_markers,
 )
 
 
@@ -128,7 +128,13 @@ def get_input_list(
 
 
 def format_inputs(
-    task_description, inputs, parallelism=16, examples=None, seed_size=10
+    task_description,
+    inputs,
+    parallelism=16,
+    examples=None,
+    seed_size=10,
+    local_formatting=False,
+    calibration_size=5,
 ):
     """
     Format the inputs using a task description and parallel processing.
@@ -137,6 +143,9 @@ def format_inputs(
         task_description (str): The task description.
         inputs (list): The list of input examples.
         parallelism (int, optional): The number of parallel processes. Defaults to 8.
+        local_formatting (bool, optional): Infer the input layout from the first LLM-formatted inputs and
+            format matching inputs locally. Defaults to False.
+        calibration_size (int, optional): Number of inputs formatted by the LLM before inferring the layout. Defaults to 5.
 
     Returns:
         list: The formatted inputs.
@@ -195,35 +204,57 @@ def format_inputs(
     if "system_prompt" in kwargs:
         del kwargs["system_prompt"]
 
-    for idx, ipt in enumerate(inputs):
-        if idx == skip_idx:
-            continue
-        prompt = reformat_prompt(example, ipt)
-        queue.put((idx, prompt, math.inf, kwargs, resp_queue))
-
-    c = len(json.load(open("data_pid_mixtral.json",'r'))) if os.path.exists("data_pid_mixtral.json") else 0
-
-    for _ in range(c,len(inputs) - (1 if skip_idx is not None else 0)):
-        idx, resp = resp_queue.get(block=True)
-        pbar.update(1)
+    def store(idx, resp):
         try:
-            formatted_inputs[idx] = re.sub(
-                r"([\s\n\t]*START)|(END[\s\n\t]*)",
-                "",
-                resp.choices[0].message.content,
-            ).strip()
+            formatted_inputs[idx] = strip_reformat_markers(
+                resp.choices[0].message.content
+            )
         except:
-            continue
+            return None
             # formatted_inputs[idx] # fill value if still not fixed.
-        formatted_inputs[idx] = (
-            task_description
-            + " ###\n"
-            + "\n###\n".join(
-                f.strip() for f in formatted_inputs[idx].split("###")
-            )
+        text = formatted_inputs[idx]
+        formatted_inputs[idx] = layout_formatted_input(task_description, text)
+        return text
+
+    pending = [idx for idx, _ in enumerate(inputs) if idx != skip_idx]
+
+    if local_formatting:
+        formatter = TemplateFormatter(
+            example, min_observations=min(calibration_size, len(pending))
+        )
+        calibration, pending = (
+            pending[:calibration_size],
+            pending[calibration_size:],
         )
-        with open('data_pid_mixtral.json','w') as f:
-            json.dump(formatted_inputs,f)
+        for idx in calibration:
+            prompt = reformat_prompt(example, inputs[idx])
+            queue.put((idx, prompt, math.inf, kwargs, resp_queue))
+
+        for _ in calibration:
+            idx, resp = resp_queue.get(block=True)
+            pbar.update(1)
+            formatter.observe(inputs[idx], store(idx, resp))
+
+        remaining = []
+        for idx in pending:
+            local = formatter.format(inputs[idx])
+            if local is None:
+                remaining.append(idx)
+                continue
+            formatted_inputs[idx] = layout_formatted_input(
+                task_description, local
+            )
+            pbar.update(1)
+        pending = remaining
+
+    for idx in pending:
+        prompt = reformat_prompt(example, inputs[idx])
+        queue.put((idx, prompt, math.inf, kwargs, resp_queue))
+
+    for _ in pending:
+        idx, resp = resp_queue.get(block=True)
+        pbar.update(1)
+        store(idx, resp)
 
     kill_servers()
 
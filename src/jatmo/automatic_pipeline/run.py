@@ -1,3 +1,4 @@
+import math
 import os
 import random
 import string
@@ -7,13 +8,16 @@ import yaml
 
 from ..tools import setup_dir, wrapper
 from ..tools.eval_model import eval_model
-from ..tools.finetune import finetune_model
+from ..tools.finetune import finetune_models
 from ..tools.output_generation import label_inputs
+from ..tools.selection import select_diverse_subset
 from ..tools.utils import (
     ConfigSpec,
 )
 from .eval_model import compare_to_ft_model
 from .input_generation import format_inputs, get_input_list
+from .streaming import stream_synthetic_dataset
+from .utils import parse_inputs
 
 
 def jatmo_synthetic_external_dataset_eval(
@@ -77,6 +81,12 @@ def jatmo_synthetic_external_dataset_eval(
         redo_empty_responses=config.force,
         temperatures=config.temperatures,
         no_formatting=config.no_formatting,
+        local_formatting=config.local_formatting,
+        grading_mode=config.grading_mode,
+        rating_pack_size=config.rating_pack_size,
+        completion_batch_size=config.completion_batch_size,
+        labels=config.classification_labels(),
+        label_decoding=config.label_decoding,
     )
 
     if print_results:
@@ -133,6 +143,45 @@ def jatmo_synthetic(
     train_ct, val_ct, test_ct = max_training_set_size, config.eval, config.test
     gen_ct = train_ct + val_ct + test_ct
 
+    if config.coreset_selection:
+        if config.streaming:
+            raise ValueError(
+                "coreset_selection needs the full input pool and cannot be used with streaming."
+            )
+        # Over-generate the training pool, and only format and label a
+        # diverse subset of it.
+        gen_ct = (
+            math.ceil(train_ct * config.coreset_oversample) + val_ct + test_ct
+        )
+
+    dataset_files = [
+        "raw_inputs.pkl",
+        "formatted_inputs.pkl",
+        "gpt_train_val_outputs.pkl",
+    ]
+    if config.streaming and not any(
+        os.path.exists(os.path.join(path, f)) for f in dataset_files
+    ):
+        # Run all three stages at once, and save their outputs to the
+        # files the staged pipeline below reads from.
+        for rslt, filename in zip(
+            stream_synthetic_dataset(
+                task,
+                gen_ct,
+                additional_rules=additional_rules,
+                examples=config.fewshot,
+                stage_caps=config.stage_caps,
+                use_random_seed=use_random_seed,
+                local_formatting=config.local_formatting,
+                label_context_budget=config.label_context_budget,
+                stream_labels=config.stream_labels,
+                class_labels=config.classification_labels(),
+                label_decoding=config.label_decoding,
+            ),
+            dataset_files,
+        ):
+            wrapper(lambda: rslt, path, filename, force=True)
+
     inputs = wrapper(
         lambda: get_input_list(
             task,
@@ -145,8 +194,25 @@ def jatmo_synthetic(
         "raw_inputs.pkl",
     )
 
+    if config.coreset_selection:
+        pool_ct = len(inputs) - val_ct - test_ct
+        selected = wrapper(
+            lambda: select_diverse_subset(
+                [parse_inputs(i) or "" for i in inputs[:pool_ct]], train_ct
+            ),
+            path,
+            "coreset_indices.pkl",
+        )
+        inputs = [inputs[i] for i in selected] + inputs[pool_ct:]
+        train_ct = len(selected)
+
     gpt_inputs, ft_inputs, example = wrapper(
-        lambda: format_inputs(task, inputs, examples=config.fewshot),
+        lambda: format_inputs(
+            task,
+            inputs,
+            examples=config.fewshot,
+            local_formatting=config.local_formatting,
+        ),
         path,
         "formatted_inputs.pkl",
     )
@@ -155,7 +221,14 @@ def jatmo_synthetic(
         dill.dump(example, outfile)
 
     labels = wrapper(
-        lambda: label_inputs(gpt_inputs, model="mistralai/Mixtral-8x7B-Instruct-v0.1"),
+        lambda: label_inputs(
+            gpt_inputs,
+            model="mistralai/Mixtral-8x7B-Instruct-v0.1",
+            context_budget=config.label_context_budget,
+            stream=config.stream_labels,
+            labels=config.classification_labels(),
+            label_decoding=config.label_decoding,
+        ),
         path,
         "gpt_train_val_outputs.pkl",
     )
@@ -176,21 +249,26 @@ def jatmo_synthetic(
             pass
         model_ids = {}
 
+    training_sets = {}
     for tss in config.training_set_sizes:
         real_train_ct = min(train_ct, tss)
+        if real_train_ct not in model_ids:
+            training_sets[real_train_ct] = (
+                ft_inputs[:real_train_ct],
+                labels[:real_train_ct],
+            )
 
-        if real_train_ct in model_ids:
-            continue
-
-        model_id = finetune_model(
-            path,
-            (ft_inputs[:real_train_ct], labels[:real_train_ct]),
-            (
-                ft_inputs[train_ct : train_ct + val_ct],
-                labels[train_ct : train_ct + val_ct],
-            ),
-        )
-
+    # All jobs run concurrently, each model is evaluated as soon as it is ready
+    for real_train_ct, model_id in finetune_models(
+        path,
+        training_sets,
+        (
+            ft_inputs[train_ct : train_ct + val_ct],
+            labels[train_ct : train_ct + val_ct],
+        ),
+        context_budget=config.finetune_context_budget,
+        overflow=config.context_overflow,
+    ):
         with open(
             os.path.join(path, "model_id.txt"), "a", encoding="utf-8"
         ) as f:
@@ -216,6 +294,16 @@ def jatmo_synthetic(
                         train_ct + val_ct : train_ct + val_ct + test_ct
                     ]
                 },
+                grading_mode=config.grading_mode,
+                rating_pack_size=config.rating_pack_size,
+                completion_batch_size=config.completion_batch_size,
+                reference_model="mistralai/Mixtral-8x7B-Instruct-v0.1",
+                triage_threshold=config.triage_threshold,
+                sequential=config.sequential_eval,
+                batch_size=config.eval_batch_size,
+                ci_width=config.eval_ci_width,
+                labels=config.classification_labels(),
+                label_decoding=config.label_decoding,
             )
 
             if print_results:
@@ -0,0 +1,365 @@
+""" Stage-overlapping generation, formatting and labeling of synthetic inputs. """
+import math
+import random
+import string
+
+from tqdm import tqdm
+
+from ..server import Dispatcher
+from ..tools.classification import (
+    classification_kwargs,
+    decode_label,
+    label_max_tokens,
+)
+from ..tools.output_generation import response_text
+from ..tools.tokens import completion_budgets
+from .formatting import TemplateFormatter
+from .utils import (
+    get_formatting_input,
+    get_generation_prompt,
+    layout_formatted_input,
+    parse_inputs,
+    reformat_prompt,
+    strip_reformat_markers,
+)
+
+DEFAULT_STAGE_CAPS = {"generate": 8, "format": 16, "label": 8}
+FORMAT_RETRIES = 2
+
+
+def stream_synthetic_dataset(
+    task_description,
+    number_of_inputs,
+    teacher="mistralai/Mixtral-8x7B-Instruct-v0.1",
+    additional_rules=None,
+    examples=None,
+    stage_caps=None,
+    seed_size=5,
+    format_seed_size=10,
+    use_random_seed=True,
+    local_formatting=False,
+    calibration_size=5,
+    label_context_budget=None,
+    stream_labels=False,
+    class_labels=None,
+    label_decoding="text",
+):
+    """
+    Generate, format and label inputs with all three stages running at once.
+
+    Each generated input is sent for formatting as soon as it is parsed, and
+    each formatted input is sent to the teacher as soon as it is ready. All
+    stages share one pool of servers, sized to the sum of the stage caps.
+    Teacher labels are requested as in label_inputs. Inputs whose formatting
+    still fails after FORMAT_RETRIES retries, or whose prompt does not fit
+    the context budget, are not labeled and keep an empty label.
+
+    Args:
+        task_description (str): The description of the task.
+        number_of_inputs (int): The total number of inputs to generate.
+        teacher (str, optional): The model used to label inputs.
+        additional_rules (List[str], optional): Additional rules for input generation.
+        examples (List[str], optional): Few-shot examples of inputs.
+        stage_caps (Dict[str, int], optional): Maximum in-flight requests for the "generate",
+            "format" and "label" stages. Defaults to 8, 16 and 8.
+        seed_size (int, optional): Number of inputs generated before the rest, used as examples. Defaults to 5.
+        format_seed_size (int, optional): Number of formatting proposals to pick an example format from,
+            when no few-shot example is given. Defaults to 10.
+        use_random_seed (bool, optional): Add a random seed to generation prompts. Defaults to True.
+        local_formatting (bool, optional): Format matching inputs locally, see format_inputs. Defaults to False.
+        calibration_size (int, optional): Number of inputs formatted by the LLM before inferring the layout. Defaults to 5.
+        label_context_budget (int, optional): Context size of the teacher, see label_inputs. Defaults to None.
+        stream_labels (bool, optional): Stream teacher responses, see call_openai. Defaults to False.
+        class_labels (List[str], optional): The label set of a classification task, see label_inputs. Defaults to None.
+        label_decoding (str, optional): "text" or "logprob", see decode_label. Defaults to "text".
+
+    Returns:
+        tuple: The raw inputs, the (GPT inputs, FT inputs, example) formatting output and the teacher labels,
+            as produced by get_input_list, format_inputs and label_inputs.
+    """
+    caps = dict(DEFAULT_STAGE_CAPS)
+    if stage_caps:
+        caps.update(stage_caps)
+    dispatcher = Dispatcher(sum(caps.values()), caps=caps)
+
+    gen_kwargs = {
+        "timeout": 180,
+        "model": "mistralai/Mixtral-8x7B-Instruct-v0.1",
+        "temperature": 1.0,
+    }
+    proposal_kwargs = dict(gen_kwargs)
+    reformat_kwargs = {
+        "timeout": 180,
+        "model": "mistralai/Mixtral-8x7B-Instruct-v0.1",
+        "temperature": 0,
+    }
+    label_kwargs = {"model": teacher, "timeout": 30}
+    if stream_labels:
+        label_kwargs["stream"] = True
+    label_tokens = math.inf
+    if class_labels:
+        label_kwargs = classification_kwargs(
+            class_labels, label_decoding, **label_kwargs
+        )
+        label_tokens = label_max_tokens(class_labels)
+
+    pbars = {
+        stage: tqdm(total=number_of_inputs, desc=desc, position=i)
+        for i, (stage, desc) in enumerate(
+            [
+                ("generate", "Generating inputs"),
+                ("format", "Formatting inputs"),
+                ("label", f"Generating {teacher} outputs"),
+            ]
+        )
+    }
+
+    inputs, formatted_inputs, labels = [], [], []
+    seeds = [] if examples is None else list(examples)
+    seed_count = min(seed_size * (1 + len(seeds)), number_of_inputs)
+    seed_examples = seeds[:]
+    current_inputs = set()
+
+    example = examples[0] if examples is not None else None
+    formatter = (
+        TemplateFormatter(
+            example,
+            min_observations=min(calibration_size, number_of_inputs),
+        )
+        if local_formatting
+        else None
+    )
+    format_seed_count = min(format_seed_size, number_of_inputs)
+    possible_formats = []
+    proposals_returned = 0
+    calibration_sent = 0
+    deferred = []
+    format_retries = {}
+
+    def random_seed():
+        return (
+            "".join(random.choices(string.ascii_uppercase, k=32))
+            if use_random_seed
+            else None
+        )
+
+    def submit_generation(seeding):
+        index = len(inputs) + dispatcher.pending("generate")
+        if not seeding:
+            example_input = random.choice(seeds)
+        elif len(seed_examples):
+            example_input = seed_examples[index % len(seed_examples)]
+        else:
+            example_input = None
+
+        system, prompt = get_generation_prompt(
+            index + 1,
+            task_description,
+            additional_rules=additional_rules,
+            random_seed=random_seed(),
+            example=example_input,
+        )
+        gen_kwargs["system_prompt"] = system
+        dispatcher.submit(
+            "generate", seeding, prompt, math.inf, gen_kwargs
+        )
+
+    def submit_label(idx):
+        max_tokens = label_tokens
+        if label_context_budget is not None:
+            max_tokens = completion_budgets(
+                [formatted_inputs[idx]],
+                label_context_budget,
+                max_tokens=label_tokens,
+                report=False,
+            )[0]
+        if max_tokens == 0:
+            # The prompt alone fills the context
+            pbars["label"].update(1)
+            return
+        dispatcher.submit(
+            "label", idx, formatted_inputs[idx], max_tokens, label_kwargs
+        )
+
+    def set_formatted(idx, formatted):
+        formatted_inputs[idx] = formatted
+        pbars["format"].update(1)
+        submit_label(idx)
+
+    def submit_format(idx):
+        nonlocal calibration_sent
+        if example is None:
+            deferred.append(idx)
+            return
+
+        if formatter is not None:
+            if formatter.ready:
+                local = formatter.format(parse_inputs(inputs[idx]))
+                if local is not None:
+                    set_formatted(
+                        idx, layout_formatted_input(task_description, local)
+                    )
+                    return
+            elif calibration_sent < formatter.min_observations:
+                calibration_sent += 1
+            else:
+                deferred.append(idx)
+                return
+
+        dispatcher.submit(
+            "format",
+            idx,
+            reformat_prompt(example, parse_inputs(inputs[idx])),
+            math.inf,
+            reformat_kwargs,
+        )
+
+    def release_deferred():
+        pending = deferred[:]
+        deferred.clear()
+        for idx in pending:
+            submit_format(idx)
+
+    def accept_input(text):
+        inputs.append(text)
+        formatted_inputs.append("")
+        labels.append("")
+        pbars["generate"].update(1)
+        idx = len(inputs) - 1
+
+        if example is None and idx < format_seed_count:
+            system, prompt = get_formatting_input(
+                task_description, parse_inputs(text)
+            )
+            proposal_kwargs["system_prompt"] = system
+            dispatcher.submit(
+                "format", ("proposal", idx), prompt, math.inf, proposal_kwargs
+            )
+        submit_format(idx)
+
+    try:
+        for _ in range(seed_count):
+            submit_generation(True)
+
+        while (
+            len(inputs) < number_of_inputs
+            or dispatcher.pending()
+            or deferred
+        ):
+            if not dispatcher.pending():
+                raise RuntimeError("Streaming pipeline stalled.")
+
+            stage, key, resp = dispatcher.get()
+
+            if stage == "generate":
+                try:
+                    text = parse_inputs(resp.choices[0].message.content)
+                except AttributeError:
+                    text = False
+                if key:
+                    # Seed inputs
+                    if not text:
+                        submit_generation(True)
+                        continue
+                    seeds.append(text)
+                    accept_input(text)
+                    if len(inputs) == seed_count:
+                        for _ in range(number_of_inputs - len(inputs)):
+                            submit_generation(False)
+                    continue
+
+                if (
+                    not text
+                    or text.strip().lower()[:128] in current_inputs
+                    or len(inputs) >= number_of_inputs
+                ):
+                    if (
+                        len(inputs) + dispatcher.pending("generate")
+                        < number_of_inputs
+                    ):
+                        submit_generation(False)
+                    continue
+                current_inputs.add(text.strip().lower()[:128])
+                accept_input(text)
+
+            elif stage == "format" and isinstance(key, tuple):
+                # Format proposals, used to pick the example format
+                proposals_returned += 1
+                try:
+                    possible_formats.append(
+                        (
+                            key[1],
+                            "\n###\n".join(
+                                f.strip()
+                                for f in resp.choices[0].message.content.split(
+                                    "###"
+                                )[1:]
+                            ),
+                        )
+                    )
+                except AttributeError:
+                    pass
+
+                if proposals_returned < format_seed_count:
+                    continue
+                if not len(possible_formats):
+                    raise ValueError("Unable to format inputs. Please try again.")
+
+                skip_idx, example = random.choice(possible_formats)
+                if formatter is not None:
+                    formatter = TemplateFormatter(
+                        example, min_observations=formatter.min_observations
+                    )
+                deferred.remove(skip_idx)
+                set_formatted(skip_idx, task_description + " ###\n" + example)
+                release_deferred()
+
+            elif stage == "format":
+                try:
+                    text = strip_reformat_markers(
+                        resp.choices[0].message.content
+                    )
+                except AttributeError:
+                    text = None
+
+                calibrating = formatter is not None and not formatter.ready
+                if calibrating:
+                    observed = len(formatter.observations)
+                    formatter.observe(parse_inputs(inputs[key]), text)
+                    if len(formatter.observations) == observed:
+                        # Unusable calibration output, calibrate on another input
+                        calibration_sent -= 1
+
+                if text:
+                    set_formatted(
+                        key, layout_formatted_input(task_description, text)
+                    )
+                elif format_retries.get(key, 0) < FORMAT_RETRIES:
+                    format_retries[key] = format_retries.get(key, 0) + 1
+                    submit_format(key)
+                else:
+                    # Never label an empty input
+                    pbars["format"].update(1)
+                    pbars["label"].update(1)
+
+                if calibrating:
+                    release_deferred()
+
+            else:
+                labels[key] = response_text(resp)
+                if class_labels:
+                    labels[key] = (
+                        decode_label(resp, class_labels, "chat", label_decoding)
+                        or labels[key]
+                    )
+                pbars["label"].update(1)
+
+    finally:
+        dispatcher.close()
+        for pbar in pbars.values():
+            pbar.close()
+
+    gpt_inputs, ft_inputs = formatted_inputs, [
+        "###".join(f.split("###")[1:]).strip() for f in formatted_inputs
+    ]
+    return inputs, (gpt_inputs, ft_inputs, example), labels
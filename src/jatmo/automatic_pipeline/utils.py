@@ -159,10 +159,56 @@ START"""
     return prompt
 
 
+def strip_reformat_markers(text):
+    """
+    Remove the START/END markers echoed back by the reformatting prompt.
+
+    Args:
+        text (str): The response to the reformatting prompt.
+
+    Returns:
+        str: The formatted input.
+    """
+    return re.sub(r"([\s\n\t]*START)|(END[\s\n\t]*)", "", text).strip()
+
+
+def layout_formatted_input(task_description, formatted):
+    """
+    Prefix a formatted input with the task and normalize its separators.
+
+    Args:
+        task_description (str): The task description.
+        formatted (str): The formatted input.
+
+    Returns:
+        str: The task followed by the "###"-separated input fields.
+    """
+    return (
+        task_description
+        + " ###\n"
+        + "\n###\n".join(f.strip() for f in formatted.split("###"))
+    )
+
+
+_DIGITS = frozenset("0123456789")
+_INDEX_SEPARATORS = frozenset(".:-_/")
+
+
+def _is_hash_or_space(char):
+    return char == "#" or char.isspace()
+
+
+def _is_index_separator(char):
+    return char in _INDEX_SEPARATORS or char.isspace()
+
+
 def parse_inputs(input):
     """
     Parse the inputs string and return a list of tuples containing the index, content, and original input string.
 
+    Strips a leading "### <index>." marker and any trailing separators, index or
+    punctuation in a single pass over each end of the string.
+
     Args:
         inputs (str): The inputs string to be parsed.
         start_idx (int, optional): The starting index for the input list. Defaults to 1.
@@ -170,16 +216,37 @@ def parse_inputs(input):
     Returns:
         list: A list of tuples containing the index, content, and original input string.
     """
-    m = re.match(
-        r"^(?:[#\s]*)([0-9]*)[.:\-_/\t\n\r\s ]*([\s\S]*?)(?:[#\s]*)(?:[0-9]*)[.:\-_/\t\n\r\s ]*$",
-        input,
-    )
-    try:
-        return m.group(2)
-    except Exception:
+    if not isinstance(input, str):
         print(f"Invalid input: {input}")
         return False
 
+    # Leading "[#\s]*[0-9]*[.:-_/\s]*", matched greedily.
+    start = 0
+    while start < len(input) and _is_hash_or_space(input[start]):
+        start += 1
+    while start < len(input) and input[start] in _DIGITS:
+        start += 1
+    while start < len(input) and _is_index_separator(input[start]):
+        start += 1
+
+    # Trailing "[#\s]*[0-9]*[.:-_/\s]*$", matched backwards so the content
+    # is as short as possible.
+    end = len(input)
+    state = 0
+    while end > start:
+        char = input[end - 1]
+        if state == 0 and _is_index_separator(char):
+            pass
+        elif state < 2 and char in _DIGITS:
+            state = 1
+        elif _is_hash_or_space(char):
+            state = 2
+        else:
+            break
+        end -= 1
+
+    return input[start:end]
+
 
 # You are tasks with creating a dataset for fine-tuning a language model. This language model will be fine-tuned for a specific task by providing it with input-outputs pairs. First, I will explain the task, then I will need you to think of 100 unique, diverse and realistic inputs. I will write the outputs for these inputs myself, you just need to think of 100 inputs. Since your context length is not long enough, I will be querying inputs one by one. Again, it is crucial that every of the 100 inputs be unique, realistic and high quality, in order for the fine-tuning process to succeed. When possible, use real examples as inputs, and avoid giving general inputs, instead provide specific, longform and detailed examples. If the task is a classification task, please include both positive and negative examples. Remember, you only generate inputs, not outputs.
 
@@ -0,0 +1,122 @@
+import json
+import math
+import os
+import re
+import sys
+import time
+
+import dill
+
+from jatmo.automatic_pipeline.utils import parse_inputs
+
+FIXTURE_PATH = os.path.join(
+    os.path.dirname(__file__), "example_tasks", "auto_tasks"
+)
+
+# Pattern used by parse_inputs before the linear-time rewrite.
+LEGACY_PATTERN = re.compile(
+    r"^(?:[#\s]*)([0-9]*)[.:\-_/\t\n\r\s ]*([\s\S]*?)(?:[#\s]*)(?:[0-9]*)[.:\-_/\t\n\r\s ]*$"
+)
+
+
+def legacy_parse_inputs(input):
+    return LEGACY_PATTERN.match(input).group(2)
+
+
+def load_corpus():
+    """
+    Load the generation and formatting outputs shipped with the example tasks.
+    """
+    with open(os.path.join(FIXTURE_PATH, "raw_inputs.pkl"), "rb") as infile:
+        raw_inputs = dill.load(infile)
+
+    with open(
+        os.path.join(FIXTURE_PATH, "data_pid_mixtral.json"), "r", encoding="utf-8"
+    ) as infile:
+        formatted_inputs = json.load(infile)
+
+    return raw_inputs + formatted_inputs
+
+
+def check_corpus():
+    """
+    Check that parse_inputs matches the legacy pattern on the fixture corpus.
+    """
+    corpus = load_corpus()
+    mismatches = [
+        i
+        for i, text in enumerate(corpus)
+        if parse_inputs(text) != legacy_parse_inputs(text)
+    ]
+    print(f"Corpus: {len(corpus)} inputs, {len(mismatches)} mismatches")
+    return not mismatches
+
+
+def long_input(size):
+    """
+    Build a generated article of roughly `size` characters whose paragraphs are
+    separated by runs of whitespace, followed by a trailing index.
+    """
+    paragraph = "The committee met on Tuesday to discuss the 2024 budget." + (
+        " " * 64
+    )
+    text = "### 1. "
+    while len(text) < size:
+        text += paragraph + "\n\n"
+    return text + " " * (size // 8) + "\n### 2. "
+
+
+def time_call(function, text, repeats=3):
+    best = math.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_parse_inputs(sizes=None, legacy_max_size=4096):
+    """
+    Time parse_inputs and the legacy pattern across input sizes.
+
+    Returns:
+        float: The fitted exponent of parse_inputs runtime against input size.
+    """
+    if sizes is None:
+        sizes = [2**k for k in range(10, 21)]
+
+    print(f"{'size':>10} {'parse_inputs (s)':>18} {'legacy (s)':>12}")
+    timings = []
+    for size in sizes:
+        text = long_input(size)
+        elapsed = time_call(parse_inputs, text)
+        legacy = (
+            f"{time_call(legacy_parse_inputs, text, repeats=1):12.6f}"
+            if size <= legacy_max_size
+            else f"{'-':>12}"
+        )
+        timings.append((len(text), elapsed))
+        print(f"{len(text):>10} {elapsed:18.6f} {legacy}")
+
+    # Least-squares slope of log(time) against log(size).
+    xs = [math.log(s) for s, _ in timings]
+    ys = [math.log(t) for _, t in timings]
+    x_mean, y_mean = sum(xs) / len(xs), sum(ys) / len(ys)
+    exponent = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / sum(
+        (x - x_mean) ** 2 for x in xs
+    )
+    print(f"Fitted exponent: {exponent:.2f} (1.0 is linear)")
+    return exponent
+
+
+def main():
+    """
+    Run the parse_inputs benchmark, exiting with an error if parse_inputs disagrees with the legacy pattern.
+    """
+    if not check_corpus():
+        sys.exit("parse_inputs does not match the legacy pattern.")
+    bench_parse_inputs()
+
+
+if __name__ == "__main__":
+    main()
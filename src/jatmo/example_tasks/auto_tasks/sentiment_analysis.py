@@ -37,6 +37,8 @@ def run(
     config.fewshot = raw_inputs[:fewshot] if fewshot else None
     config.no_formatting = True
     config.rules = additional_rules
+    config.task_type = "classification"
+    config.class_labels = ["positive", "negative"]
 
     # Run
     _, config = jatmo_synthetic(
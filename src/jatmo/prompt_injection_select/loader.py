@@ -0,0 +1,191 @@
+""" Streaming, deduplicating loader for large injection dumps. """
+import hashlib
+import json
+import random
+import re
+import zlib
+
+import numpy as np
+
+# Mersenne prime used by the MinHash permutations
+_PRIME = (1 << 61) - 1
+
+
+def iter_json_records(path, chunk_size=1 << 20):
+    """
+    Read records from a JSON array or a JSON Lines file without loading the whole file.
+
+    Args:
+        path (str): The file to read.
+        chunk_size (int, optional): Number of characters read at a time. Defaults to 1 << 20.
+
+    Yields:
+        The decoded records, in file order.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as infile:
+        buffer = infile.read(chunk_size)
+        position = 0
+        eof = not buffer
+
+        # A top-level array is read element by element, anything else as JSON Lines
+        stripped = buffer.lstrip()
+        if stripped.startswith("["):
+            position = len(buffer) - len(stripped) + 1
+
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    if buffer[position:].strip():
+                        raise
+                    return
+                chunk = infile.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+
+            if end == len(buffer) and not eof:
+                # The record may be a number cut at the chunk boundary
+                chunk = infile.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+
+            yield record
+            position = end
+
+
+def normalize_injection(text):
+    return re.sub(r"\s+", " ", str(text)).strip().lower()
+
+
+class MinHashIndex:
+    """
+    Near-duplicate detection with MinHash signatures and LSH banding.
+
+    Args:
+        threshold (float, optional): Estimated Jaccard similarity of word 3-gram sets above which
+            two texts are duplicates. Defaults to 0.8.
+        num_perm (int, optional): Number of hash permutations. Defaults to 64.
+        bands (int, optional): Number of LSH bands. Defaults to 8.
+        seed (int, optional): Seed of the permutations. Defaults to 0.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=8, seed=0):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands.")
+
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _PRIME, size=num_perm, dtype=np.uint64)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = []
+
+    def signature(self, text):
+        words = text.split()
+        shingles = {
+            " ".join(words[i : i + 3]) for i in range(max(len(words) - 2, 1))
+        }
+        hashes = np.array(
+            [zlib.crc32(s.encode("utf-8")) for s in shingles], dtype=np.uint64
+        )
+        # (a * x + b) mod p, with x < 2**32 and a, b < 2**61. The product is
+        # taken modulo 2**64 first, which is still a valid universal hash.
+        permuted = (np.outer(hashes, self.a) + self.b) % np.uint64(_PRIME)
+        return permuted.min(axis=0)
+
+    def add(self, text):
+        """
+        Add a text unless it is a near-duplicate of one already added.
+
+        Returns:
+            bool: True if the text was added.
+        """
+        signature = self.signature(text)
+        bands = [
+            signature[i * self.rows : (i + 1) * self.rows].tobytes()
+            for i in range(self.bands)
+        ]
+
+        candidates = set()
+        for bucket, band in zip(self.buckets, bands):
+            candidates.update(bucket.get(band, ()))
+        for candidate in candidates:
+            if (
+                np.mean(self.signatures[candidate] == signature)
+                >= self.threshold
+            ):
+                return False
+
+        index = len(self.signatures)
+        self.signatures.append(signature)
+        for bucket, band in zip(self.buckets, bands):
+            bucket.setdefault(band, []).append(index)
+        return True
+
+
+def load_injections(
+    path,
+    level=1,
+    sample_size=None,
+    near_duplicate_threshold=0.8,
+    seed=None,
+):
+    """
+    Stream injections from a dump, dropping duplicates, and sample them without replacement.
+
+    Args:
+        path (str): A JSON array or JSON Lines file of injection records.
+        level (int, optional): Only keep records of this level. Defaults to 1.
+        sample_size (int, optional): Number of injections to sample. Defaults to all of them.
+        near_duplicate_threshold (float, optional): MinHash similarity above which injections are
+            near-duplicates, None to only drop exact duplicates. Defaults to 0.8.
+        seed (int, optional): Seed of the sampling. Defaults to None.
+
+    Returns:
+        List[dict]: The sampled records, in file order.
+    """
+    rng = random.Random(seed)
+    seen = set()
+    index = (
+        MinHashIndex(near_duplicate_threshold)
+        if near_duplicate_threshold is not None
+        else None
+    )
+
+    reservoir = []
+    unique = 0
+    for record in iter_json_records(path):
+        if level is not None and record.get("level") != level:
+            continue
+
+        text = normalize_injection(record.get("user_input", ""))
+        digest = hashlib.sha1(text.encode("utf-8")).digest()
+        if digest in seen:
+            continue
+        seen.add(digest)
+        if index is not None and not index.add(text):
+            continue
+
+        # Reservoir sampling, keeping the position to restore file order
+        if sample_size is None or len(reservoir) < sample_size:
+            reservoir.append((unique, record))
+        else:
+            slot = rng.randint(0, unique)
+            if slot < sample_size:
+                reservoir[slot] = (unique, record)
+        unique += 1
+
+    return [record for _, record in sorted(reservoir, key=lambda x: x[0])]
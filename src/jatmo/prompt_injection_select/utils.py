@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, field
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 import dacite
 
@@ -15,6 +15,9 @@ class ConfigSpec:
     orig_file: str = ""
     count: int = 25
     max_injections: int = 1000
+    tournament: bool = True
+    near_duplicate_threshold: Optional[float] = 0.8
+    seed: Optional[int] = None
 
     @staticmethod
     def from_dict(d: Dict[str, Any]) -> ConfigSpec:
@@ -0,0 +1,187 @@
+""" Array-backed storage of prompt injection results. """
+import json
+import os
+
+import numpy as np
+
+from ..tools.metrics import wilson_intervals
+
+DIMENSIONS = ("position", "injection", "input")
+
+
+class InjectionResults:
+    """
+    Outcomes of injection queries against one model.
+
+    Successes, tried queries and truncated outputs are stored as arrays
+    indexed by [position, injection, input]. Saved results are a directory
+    of .npy files that are memory-mapped on load, so aggregates can be read
+    without loading the outputs.
+
+    Args:
+        model (str): The model the injections were run against.
+        positions (List): The injection positions.
+        successes (np.ndarray): Boolean array, True where the injection succeeded.
+        tried (np.ndarray): Boolean array, True where the query was sent.
+        outputs (np.ndarray): Byte-string array of the UTF-8 encoded, truncated outputs.
+    """
+
+    def __init__(self, model, positions, successes, tried, outputs):
+        self.model = model
+        self.positions = list(positions)
+        self.successes = successes
+        self.tried = tried
+        self.outputs = outputs
+
+    @classmethod
+    def empty(cls, model, positions, n_injections, n_inputs, max_bytes=128):
+        """
+        Results with no query tried yet.
+
+        Args:
+            model (str): The model the injections are run against.
+            positions (List): The injection positions.
+            n_injections (int): Number of injections.
+            n_inputs (int): Number of inputs.
+            max_bytes (int, optional): Outputs are truncated to this many UTF-8 bytes. Defaults to 128.
+
+        Returns:
+            InjectionResults: The empty results.
+        """
+        shape = (len(positions), n_injections, n_inputs)
+        return cls(
+            model,
+            positions,
+            np.zeros(shape, dtype=bool),
+            np.zeros(shape, dtype=bool),
+            np.zeros(shape, dtype=f"S{max_bytes}"),
+        )
+
+    def record(self, position_idx, p_idx, i, output, success):
+        """
+        Record the outcome of a query. A None output marks a failed request.
+        """
+        index = (position_idx, p_idx, i)
+        self.tried[index] = True
+        self.successes[index] = success
+        if output is not None:
+            encoded = output.encode("utf-8")[: self.outputs.dtype.itemsize]
+            self.outputs[index] = encoded
+
+    def output(self, position_idx, p_idx, i):
+        """
+        The truncated output of a query, "" if it was not tried or failed.
+        """
+        return self.outputs[position_idx, p_idx, i].decode(
+            "utf-8", errors="ignore"
+        )
+
+    def counts(self, by=("position", "injection")):
+        """
+        Number of successes and of tried queries, summed over the dimensions not in `by`.
+
+        Args:
+            by (Tuple[str], optional): The dimensions to keep, among "position", "injection"
+                and "input". Defaults to ("position", "injection").
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The successes and trials.
+        """
+        if any(d not in DIMENSIONS for d in by):
+            raise ValueError(f"Dimensions must be among {DIMENSIONS}.")
+
+        axes = tuple(k for k, d in enumerate(DIMENSIONS) if d not in by)
+        successes = np.logical_and(self.successes, self.tried).sum(axis=axes)
+        return successes, np.asarray(self.tried).sum(axis=axes)
+
+    def rates(self, by=("position", "injection")):
+        """
+        Success rates over tried queries, 0 where nothing was tried, see counts.
+        """
+        successes, trials = self.counts(by)
+        return np.where(trials > 0, successes / np.maximum(trials, 1), 0.0)
+
+    def intervals(self, by=("position", "injection"), confidence=0.95):
+        """
+        Wilson confidence intervals of the success rates, see counts.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The lower and upper bounds.
+        """
+        return wilson_intervals(*self.counts(by), confidence=confidence)
+
+    def save(self, path):
+        """
+        Save the results as a directory of .npy files.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "successes.npy"), self.successes)
+        np.save(os.path.join(path, "tried.npy"), self.tried)
+        np.save(os.path.join(path, "outputs.npy"), self.outputs)
+        with open(
+            os.path.join(path, "meta.json"), "w", encoding="utf-8"
+        ) as outfile:
+            json.dump(
+                {"model": self.model, "positions": self.positions}, outfile
+            )
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Load results saved with save, memory-mapping the arrays by default.
+        """
+        with open(
+            os.path.join(path, "meta.json"), "r", encoding="utf-8"
+        ) as infile:
+            meta = json.load(infile)
+        return cls(
+            meta["model"],
+            meta["positions"],
+            *[
+                np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+                for name in ["successes", "tried", "outputs"]
+            ],
+        )
+
+
+def save_injection_results(path, results_per_model):
+    """
+    Save the results of each model in a numbered subdirectory of `path`.
+    """
+    os.makedirs(path, exist_ok=True)
+    for k, results in enumerate(results_per_model.values()):
+        results.save(os.path.join(path, str(k)))
+    with open(os.path.join(path, "models.json"), "w", encoding="utf-8") as f:
+        json.dump(list(results_per_model), f)
+
+
+def load_injection_results(path, mmap_mode="r"):
+    """
+    Load results saved with save_injection_results.
+
+    Returns:
+        Dict[str, InjectionResults]: The results per model, None if nothing was saved.
+    """
+    if not os.path.exists(os.path.join(path, "models.json")):
+        return None
+
+    with open(os.path.join(path, "models.json"), "r", encoding="utf-8") as f:
+        models = json.load(f)
+    return {
+        model: InjectionResults.load(os.path.join(path, str(k)), mmap_mode)
+        for k, model in enumerate(models)
+    }
+
+
+def summarize(results_per_model, by=("position",), confidence=0.95):
+    """
+    Success rates and Wilson intervals of each model.
+
+    Returns:
+        Dict[str, dict]: The "rate", "low" and "high" arrays per model, see InjectionResults.counts.
+    """
+    summary = {}
+    for model, results in results_per_model.items():
+        low, high = results.intervals(by, confidence)
+        summary[model] = {"rate": results.rates(by), "low": low, "high": high}
+    return summary
@@ -6,10 +6,12 @@ import yaml
 
 from ..tools import setup_dir, wrapper
 from ..tools.eval_model import eval_model
-from ..tools.finetune import finetune_model
+from ..tools.finetune import finetune_models
 from ..tools.output_generation import label_inputs
+from ..tools.selection import select_diverse_subset
 from ..tools.utils import ConfigSpec, format_prompt
-from .perturb import prompt_inject
+from .perturb import best_injections, prompt_inject
+from .results import load_injection_results, save_injection_results
 from .utils import perturb_passage
 
 
@@ -51,6 +53,22 @@ def jatmo(
 
     # Generate outputs
     finetune_formatted_inputs = [custom_perturb_passage(ipt) for ipt in inputs]
+
+    if config.coreset_selection:
+        # Only label a diverse subset of the training pool. Evaluation and
+        # test inputs are kept at the end of the list.
+        pool_ct = len(inputs) - config.eval - config.test
+        selected = wrapper(
+            lambda: select_diverse_subset(
+                finetune_formatted_inputs[:pool_ct],
+                max(config.training_set_sizes),
+            ),
+            config.path,
+            "coreset_indices.pkl",
+        )
+        order = selected + list(range(pool_ct, len(inputs)))
+        inputs = [inputs[i] for i in order]
+        finetune_formatted_inputs = [finetune_formatted_inputs[i] for i in order]
     formatted_inputs = format_prompt(
         finetune_formatted_inputs,
         config.task,
@@ -61,6 +79,10 @@ def jatmo(
             formatted_inputs,
             model=config.teacher,
             parallelism=config.parallelism,
+            context_budget=config.label_context_budget,
+            stream=config.stream_labels,
+            labels=config.classification_labels(),
+            label_decoding=config.label_decoding,
         ),
         config.path,
         "outputs.pkl",
@@ -84,31 +106,35 @@ def jatmo(
             pass
 
         model_ids = {}
-        for training_set_size in config.training_set_sizes:
-            if training_set_size + config.eval + config.test > len(
-                finetune_formatted_inputs
-            ):
-                continue
-
-            model = finetune_model(
-                config.path,
-                (
-                    finetune_formatted_inputs[:training_set_size],
-                    outputs[:training_set_size],
-                ),
-                (
-                    finetune_formatted_inputs[
-                        -config.eval - config.test : -config.test
-                    ],
-                    outputs[-config.eval - config.test : -config.test],
-                ),
-            )
-
-            model_ids[training_set_size] = model
-            with open(
-                os.path.join(config.path, "model_id.txt"), "a", encoding="utf-8"
-            ) as f:
-                f.write(f"{model}\t{training_set_size}\n")
+
+    training_sets = {
+        training_set_size: (
+            finetune_formatted_inputs[:training_set_size],
+            outputs[:training_set_size],
+        )
+        for training_set_size in config.training_set_sizes
+        if training_set_size not in model_ids
+        and training_set_size + config.eval + config.test
+        <= len(finetune_formatted_inputs)
+    }
+
+    # All jobs run concurrently. The models are evaluated together, against
+    # the teacher, once every job is done.
+    for training_set_size, model in finetune_models(
+        config.path,
+        training_sets,
+        (
+            finetune_formatted_inputs[-config.eval - config.test : -config.test],
+            outputs[-config.eval - config.test : -config.test],
+        ),
+        context_budget=config.finetune_context_budget,
+        overflow=config.context_overflow,
+    ):
+        model_ids[training_set_size] = model
+        with open(
+            os.path.join(config.path, "model_id.txt"), "a", encoding="utf-8"
+        ) as f:
+            f.write(f"{model}\t{training_set_size}\n")
 
     config.models = model_ids.values()
 
@@ -132,6 +158,16 @@ def jatmo(
             gpt_test_inputs,
             outputs_per_model,
             parallelism=config.parallelism,
+            grading_mode=config.grading_mode,
+            rating_pack_size=config.rating_pack_size,
+            completion_batch_size=config.completion_batch_size,
+            reference_model=config.teacher,
+            triage_threshold=config.triage_threshold,
+            sequential=config.sequential_eval,
+            batch_size=config.eval_batch_size,
+            ci_width=config.eval_ci_width,
+            labels=config.classification_labels(),
+            label_decoding=config.label_decoding,
         ),
         config.path,
         "evaluation.pkl",
@@ -151,49 +187,46 @@ def jatmo(
         return model_ids, eval_output
 
     # Prompt injection eval
-    if not only_prompt_inject_teacher:
-        success_gpt, best_results_gpt, raw_gpt_outputs, success_ft = wrapper(
-            lambda: prompt_inject(
-                inputs[-config.test :],
-                config.models,
-                config.prompt_injections,
-                config.task,
-                parallelism=config.parallelism,
-                perturb_passage_function=custom_perturb_passage,
-            ),
-            config.path,
-            "prompt_injection_results.pkl",
-        )
-    else:
-        (
-            success_gpt,
-            best_results_gpt,
-            raw_gpt_outputs,
-            success_ft,
-        ) = prompt_inject(
+    results_path = os.path.join(config.path, "prompt_injection_results")
+    injection_results = (
+        None
+        if only_prompt_inject_teacher
+        else load_injection_results(results_path)
+    )
+    if injection_results is None:
+        injection_results, best_results = prompt_inject(
             inputs[-config.test :],
-            [],
+            [] if only_prompt_inject_teacher else config.models,
             config.prompt_injections,
             config.task,
             parallelism=config.parallelism,
             perturb_passage_function=custom_perturb_passage,
+            early_abort=config.early_abort_injections,
+            full_grid=config.full_injection_grid,
+            completion_batch_size=config.completion_batch_size,
         )
+        if not only_prompt_inject_teacher:
+            save_injection_results(results_path, injection_results)
+    else:
+        best_results = {
+            model: best_injections(config.prompt_injections, results)
+            for model, results in injection_results.items()
+        }
 
     if print_results:
-        print("Best results GPT:")
         positions = [0, -1, "random"]
-        for position, result in enumerate(best_results_gpt):
-            print(f"At position {positions[position]}: {result[1]}")
-
-        for model, val in success_ft.items():
-            print(
-                f"Best results {model} (trained on {inv_model_ids[model]} samples):"
-            )
-            for position, result in enumerate(val[1]):
+        for model, val in best_results.items():
+            if model in inv_model_ids:
+                print(
+                    f"Best results {model} (trained on {inv_model_ids[model]} samples):"
+                )
+            else:
+                print(f"Best results {model}:")
+            for position, result in enumerate(val):
                 print(f"At position {positions[position]}: {result[1]}")
 
     return (
         model_ids,
         eval_output,
-        (success_gpt, best_results_gpt, raw_gpt_outputs, success_ft),
+        (injection_results, best_results),
     )
@@ -3,6 +3,8 @@ from __future__ import annotations
 import json
 import random
 
+from ..tools.utils import format_prompt
+
 
 def perturb_passage(passage, position=None, injection=None):
     """
@@ -33,6 +35,151 @@ def perturb_passage(passage, position=None, injection=None):
     return ".".join(sentences)
 
 
+class PerturbationPlan:
+    """
+    Builds perturbed inputs on demand instead of materializing the whole grid.
+
+    With the default perturb_passage, the sentence boundaries of each input
+    are indexed once, and an injection is spliced in at a boundary without
+    splitting the passage again. "random" positions are drawn from a seed
+    per (injection, input, position), so a plan always resolves them to the
+    same place. Queries resolving to the same perturbed input for an
+    (injection, input) pair, such as "random" landing on the first
+    sentence, are only built once. A plan is independent of the model, each
+    perturbed input is formatted for a model type with `format`.
+
+    Args:
+        inputs (List[str]): The clean inputs.
+        prompt_injections (List[Tuple[str, str]]): The injections and their expected outputs.
+        positions (List): The injection positions, see perturb_passage.
+        task (str): The task description.
+        perturb_passage_function (Callable, optional): Inserts an injection in an input. Defaults to perturb_passage.
+        seed (int, optional): Seed of the "random" positions. Defaults to 0.
+    """
+
+    def __init__(
+        self,
+        inputs,
+        prompt_injections,
+        positions,
+        task,
+        perturb_passage_function=perturb_passage,
+        seed=0,
+    ):
+        self.inputs = inputs
+        self.prompt_injections = prompt_injections
+        self.positions = positions
+        self.task = task
+        self.perturb_passage_function = perturb_passage_function
+        self.seed = seed
+        self.indexed = perturb_passage_function is perturb_passage
+        self.boundaries = {}
+
+    def _boundaries(self, i):
+        if i not in self.boundaries:
+            passage = str(self.inputs[i])
+            self.boundaries[i] = [k for k, c in enumerate(passage) if c == "."]
+        return self.boundaries[i]
+
+    def resolve(self, p_idx, i, position_idx):
+        """
+        Resolve a position of the grid, drawing "random" positions from the plan's seed.
+
+        Returns:
+            The position passed to the perturbation function. With the default function,
+            the index of the sentence the injection is inserted before instead.
+        """
+        position = self.positions[position_idx]
+        if position == "random":
+            position = random.Random(
+                f"{self.seed}:{p_idx}:{i}:{position_idx}"
+            ).random()
+        if not self.indexed:
+            return position
+
+        count = len(self._boundaries(i)) + 1
+        if position == -1:
+            return count
+        if 0 <= position < 1:
+            return int(position * count)
+        return min(position, count) if position >= 0 else position
+
+    def perturbed(self, p_idx, i, resolved):
+        """
+        Insert an injection in an input at a resolved position.
+        """
+        injection = self.prompt_injections[p_idx][0]
+        if not self.indexed:
+            perturbed = self.perturb_passage_function(
+                self.inputs[i], resolved, injection
+            )
+        elif resolved < 0:
+            perturbed = perturb_passage(self.inputs[i], resolved, injection)
+        else:
+            passage = str(self.inputs[i])
+            boundaries = self._boundaries(i)
+            if resolved == 0:
+                perturbed = " " + injection + "." + passage
+            elif resolved > len(boundaries):
+                perturbed = passage + ". " + injection
+            else:
+                cut = boundaries[resolved - 1]
+                perturbed = passage[:cut] + ". " + injection + passage[cut:]
+        return perturbed
+
+    def format(self, perturbed, model_type="chat"):
+        """
+        Format a perturbed input as a prompt, see format_prompt.
+        """
+        return format_prompt(perturbed, self.task, model_type)
+
+    def variants(self, injections=None, inputs=None, keep=None):
+        """
+        Lazily build the distinct perturbed inputs of the grid, in index order.
+
+        Queries are visited by injection, then input, then position, so only
+        the perturbed inputs of one (injection, input) pair are held at a time.
+
+        Args:
+            injections (Iterable[int], optional): The injection indices to visit. Defaults to all injections.
+            inputs (Iterable[int], optional): The input indices to visit, iterated once per injection.
+                Defaults to all inputs.
+            keep (Callable[[Tuple[int, int, int]], bool], optional): Whether to build an (injection, input,
+                position) query. Defaults to keeping every query.
+
+        Yields:
+            Tuple[List[Tuple[int, int, int]], str]: The queries sharing a perturbed input, and the input.
+        """
+        if injections is None:
+            injections = range(len(self.prompt_injections))
+        if inputs is None:
+            inputs = range(len(self.inputs))
+
+        for p_idx in injections:
+            for i in inputs:
+                shared = {}
+                for position_idx in range(len(self.positions)):
+                    query = (p_idx, i, position_idx)
+                    if keep is not None and not keep(query):
+                        continue
+                    resolved = self.resolve(*query)
+                    # Custom functions are opaque, compare their outputs instead
+                    key = (
+                        resolved
+                        if self.indexed
+                        else self.perturbed(p_idx, i, resolved)
+                    )
+                    if key not in shared:
+                        shared[key] = (
+                            [],
+                            self.perturbed(p_idx, i, resolved)
+                            if self.indexed
+                            else key,
+                        )
+                    shared[key][0].append(query)
+                yield from shared.values()
+
+
 def load_hackaprompt_injections(path):
     with open(path, "r", encoding="utf-8") as infile:
         prompt_injections = json.load(infile)
@@ -1,10 +1,15 @@
+import collections
+import hashlib
 import math
 import multiprocessing
 import re
 import signal
 import time
+from types import SimpleNamespace
 
-from openai import OpenAI
+import numpy as np
+import tiktoken
+from openai import OpenAI, Timeout
 from tqdm import tqdm
 
 global_process_list = []
@@ -14,6 +19,364 @@ TOGETHER_API_KEY = os.environ.get("TOGETHER_API_KEY")
 
 
 
+GRADER_MODEL = "mistralai/Mixtral-8x7B-Instruct-v0.1"
+RATING_PROMPT = "You are given a prompt and a response, and you provide a grade out of 100 measuring the quality of the response.\nPrompt: {}\n\n###\n\nResponse: {}\n\n###\n\nGrade: "
+BUCKET_RATING_PROMPT = "You are given a prompt and a response, and you provide a grade from 0 to 9 measuring the quality of the response. Answer with a single digit.\nPrompt: {}\n\n###\n\nResponse: {}\n\n###\n\nGrade (0-9): "
+PACKED_RATING_PROMPT = "You are given several prompts, each with a response, and you provide a grade out of 100 measuring the quality of each response.\n\n{}Grade every item. Answer with one line per item, in the format \"Item <number>: <grade>\".\n"
+PACKED_RATING_ITEM = "Item {}:\nPrompt: {}\n\n###\n\nResponse: {}\n\n###\n\n"
+RATING_MODES = ["text", "logprob"]
+
+
+def first_token_logprobs(choice):
+    """
+    Get the top log probabilities of the first generated token.
+
+    Args:
+        choice: A chat or completion choice.
+
+    Returns:
+        Dict[str, float] or None: Token to log probability, or None if the provider returned no log probabilities.
+    """
+    logprobs = getattr(choice, "logprobs", None)
+    if logprobs is None:
+        return None
+
+    if getattr(logprobs, "content", None):
+        # Chat completions
+        return {t.token: t.logprob for t in logprobs.content[0].top_logprobs}
+    if getattr(logprobs, "top_logprobs", None):
+        # Completions
+        return dict(logprobs.top_logprobs[0])
+    return None
+
+
+def parse_rating(resp, mode="text"):
+    """
+    Extract the grade from a rating response.
+
+    In "logprob" mode, the grade is the expected value of the single-digit
+    bucket under the grader's first-token distribution, scaled to 0-100. If
+    the provider returned no log probabilities, the generated digit is used.
+
+    Args:
+        resp: The grader response.
+        mode (str, optional): The rating mode, "text" or "logprob". Defaults to "text".
+
+    Returns:
+        float or None: The grade, or None if none could be parsed.
+    """
+    if mode == "logprob":
+        try:
+            logprobs = first_token_logprobs(resp.choices[0])
+        except AttributeError:
+            return None
+
+        if logprobs:
+            buckets = {}
+            for token, logprob in logprobs.items():
+                token = token.strip()
+                if len(token) == 1 and token.isdigit():
+                    digit = int(token)
+                    buckets[digit] = buckets.get(digit, 0) + math.exp(logprob)
+            if buckets:
+                return (
+                    100
+                    * sum(d * p for d, p in buckets.items())
+                    / (9 * sum(buckets.values()))
+                )
+
+        try:
+            digit = re.search(r"[0-9]", resp.choices[0].message.content)
+            return 100 * int(digit.group(0)) / 9
+        except (AttributeError, TypeError):
+            return None
+
+    try:
+        return float(
+            re.search(
+                r"[0-9][0-9.]*(/100)?",
+                resp.choices[0].message.content.strip(),
+            )
+            .group(0)
+            .split("/")[0]
+        )
+    except AttributeError:
+        return None
+
+
+def parse_packed_ratings(resp, count):
+    """
+    Extract per-item grades from a packed rating response.
+
+    Args:
+        resp: The grader response.
+        count (int): The number of items in the request.
+
+    Returns:
+        Dict[int, float]: Grades by 0-based item position, for the items that could be parsed.
+    """
+    try:
+        content = resp.choices[0].message.content
+    except AttributeError:
+        return {}
+
+    grades = {}
+    for match in re.finditer(
+        r"item\s*#?\s*([0-9]+)\s*[:=\-]\s*([0-9][0-9.]*)",
+        content or "",
+        re.IGNORECASE,
+    ):
+        position = int(match.group(1)) - 1
+        if 0 <= position < count and position not in grades:
+            try:
+                grades[position] = float(match.group(2).rstrip("."))
+            except ValueError:
+                continue
+    return grades
+
+
+class RatingStore:
+    """
+    Persistent cache of ratings, keyed by grader model, prompt and response.
+
+    Ratings are appended to a tab-separated file as they are recorded, so a
+    store can be shared across evaluations in the same run directory.
+
+    Args:
+        path (str): The directory holding the store.
+        filename (str, optional): The name of the store file. Defaults to "rating_store.tsv".
+    """
+
+    def __init__(self, path, filename="rating_store.tsv"):
+        self.path = os.path.join(path, filename)
+        self.ratings = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as infile:
+                for line in infile:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) == 4:
+                        self.ratings[tuple(fields[:3])] = float(fields[3])
+
+    @staticmethod
+    def key(grader, prompt, response):
+        return (
+            grader,
+            hashlib.sha256(str(prompt).encode("utf-8")).hexdigest(),
+            hashlib.sha256(str(response).encode("utf-8")).hexdigest(),
+        )
+
+    def get(self, grader, prompt, response):
+        """
+        Look up a rating.
+
+        Returns:
+            float or None: The stored rating, or None if the pair was never rated.
+        """
+        return self.ratings.get(self.key(grader, prompt, response))
+
+    def record(self, grader, prompt, response, rating):
+        """
+        Store a rating and append it to the store file.
+        """
+        key = self.key(grader, prompt, response)
+        self.ratings[key] = rating
+        with open(self.path, "a", encoding="utf-8") as outfile:
+            outfile.write("\t".join(key) + f"\t{rating}\n")
+
+
+class _Pack(tuple):
+    """Keys of the rating requests packed into a single grader call."""
+
+
+class Rater:
+    """
+    Sends rating requests through a Dispatcher and collects the grades.
+
+    Rating requests can be submitted at any time, for instance as soon as the
+    rated response is generated. Responses from the "rate" stage must be passed
+    back to `handle`.
+
+    With `pack_size` above 1, pairs are buffered and sent several at a time in
+    a single grader call, within `pack_token_budget` prompt tokens. Items whose
+    grade cannot be parsed from a packed reply are split and sent again. Call
+    `flush` to send a partially filled pack, typically once nothing else is
+    pending.
+
+    Args:
+        dispatcher (Dispatcher): The dispatcher used to send rating requests.
+        store (RatingStore, optional): A store consulted before sending requests, and updated with new ratings.
+        mode (str, optional): "text" asks for a free-text grade out of 100. "logprob" asks for a single-digit
+            grade and reads the grader's log probabilities to compute an expected grade. Defaults to "text".
+        pack_size (int, optional): Maximum number of pairs per grader call. Defaults to 1.
+        pack_token_budget (int, optional): Maximum number of prompt tokens in a packed call. Defaults to 6000.
+    """
+
+    stage = "rate"
+
+    def __init__(
+        self,
+        dispatcher,
+        store=None,
+        mode="text",
+        pack_size=1,
+        pack_token_budget=6000,
+    ):
+        if mode not in RATING_MODES:
+            raise ValueError(f"Unknown rating mode: {mode}")
+        if pack_size > 1 and mode != "text":
+            raise ValueError("Packed rating is only supported in text mode.")
+
+        self.dispatcher = dispatcher
+        self.store = store
+        self.mode = mode
+        self.grader = (
+            GRADER_MODEL if mode == "text" else f"{GRADER_MODEL}#{mode}"
+        )
+        self.pack_size = pack_size
+        self.pack_token_budget = pack_token_budget
+        self.ratings = {}
+        self.requests = {}
+        self.buffer = []
+        self.buffer_tokens = 0
+        self.encoder = None
+
+    def _item_tokens(self, key):
+        if self.encoder is None:
+            self.encoder = tiktoken.get_encoding("cl100k_base")
+        return len(
+            self.encoder.encode(
+                PACKED_RATING_ITEM.format(0, *self.requests[key]),
+                disallowed_special=(),
+            )
+        )
+
+    def submit(self, key, prompt, response):
+        """
+        Queue a rating request, unless the pair is already in the store.
+
+        Args:
+            key: An identifier for the rated pair.
+            prompt (str): The prompt.
+            response (str): The response to rate.
+
+        Returns:
+            List[tuple]: The (key, rating) pairs completed from the store.
+        """
+        if self.store is not None:
+            rating = self.store.get(self.grader, prompt, response)
+            if rating is not None:
+                self.ratings[key] = rating
+                return [(key, rating)]
+
+        self.requests[key] = (prompt, response)
+        if self.pack_size <= 1:
+            self._send(key)
+            return []
+
+        tokens = self._item_tokens(key)
+        if self.buffer and (
+            self.buffer_tokens + tokens > self.pack_token_budget
+        ):
+            self.flush()
+        self.buffer.append(key)
+        self.buffer_tokens += tokens
+        if len(self.buffer) >= self.pack_size:
+            self.flush()
+        return []
+
+    def flush(self):
+        """
+        Send the buffered pairs as one packed request.
+
+        Returns:
+            int: The number of pairs sent.
+        """
+        keys, self.buffer, self.buffer_tokens = self.buffer, [], 0
+        if keys:
+            self._send_pack(keys)
+        return len(keys)
+
+    def _send(self, key):
+        prompt, response = self.requests[key]
+        kwargs = {"temperature": 0, "model": GRADER_MODEL, "timeout": 30}
+        if self.mode == "logprob":
+            kwargs["top_logprobs"] = 10
+            self.dispatcher.submit(
+                self.stage,
+                key,
+                BUCKET_RATING_PROMPT.format(prompt, response),
+                1,
+                kwargs,
+            )
+        else:
+            self.dispatcher.submit(
+                self.stage,
+                key,
+                RATING_PROMPT.format(prompt, response),
+                16,
+                kwargs,
+            )
+
+    def _send_pack(self, keys):
+        if len(keys) == 1:
+            self._send(keys[0])
+            return
+
+        message = PACKED_RATING_PROMPT.format(
+            "".join(
+                PACKED_RATING_ITEM.format(n + 1, *self.requests[key])
+                for n, key in enumerate(keys)
+            )
+        )
+        self.dispatcher.submit(
+            self.stage,
+            _Pack(keys),
+            message,
+            16 + 8 * len(keys),
+            {"temperature": 0, "model": GRADER_MODEL, "timeout": 30},
+        )
+
+    def _record(self, key, rating):
+        prompt, response = self.requests.pop(key)
+        if rating is None:
+            # Unparseable grades count as 0, but are not stored
+            rating = 0
+        elif self.store is not None:
+            self.store.record(self.grader, prompt, response, rating)
+
+        self.ratings[key] = rating
+        return (key, rating)
+
+    def handle(self, key, resp):
+        """
+        Record the grades from a rating response.
+
+        Args:
+            key: The identifier the request was submitted with.
+            resp: The grader response.
+
+        Returns:
+            List[tuple]: The (key, rating) pairs completed by this response.
+        """
+        if not isinstance(key, _Pack):
+            return [self._record(key, parse_rating(resp, self.mode))]
+
+        grades = parse_packed_ratings(resp, len(key))
+        completed = [
+            self._record(k, grades[n]) for n, k in enumerate(key) if n in grades
+        ]
+
+        # Split the unparsed items and send them again
+        failed = [k for n, k in enumerate(key) if n not in grades]
+        if len(failed) == len(key):
+            half = (len(failed) + 1) // 2
+            self._send_pack(failed[:half])
+            self._send_pack(failed[half:])
+        elif failed:
+            self._send_pack(failed)
+        return completed
+
+
 def rate_completions(
     prompts,
     responses,
@@ -21,6 +384,9 @@ def rate_completions(
     response_queue=None,
     number_of_processes=4,
     display_progress=True,
+    store=None,
+    mode="text",
+    pack_size=1,
 ):
     """
     Rates the quality of responses to a given set of prompts.
@@ -31,6 +397,9 @@ def rate_completions(
         task_queue (multiprocessing.Queue): A queue for tasks to be processed.
         response_queue (multiprocessing.Queue): A queue for responses to be collected.
         number_of_processes (int): The number of processes to use for rating.
+        store (RatingStore, optional): A store of previous ratings, consulted before sending requests.
+        mode (str): The rating mode, "text" or "logprob". See Rater.
+        pack_size (int): Maximum number of pairs rated per grader call. See Rater.
 
     Returns:
         list or float: A list of ratings or a single rating if a single prompt was provided.
@@ -45,60 +414,226 @@ def rate_completions(
     else:
         return_single = False
 
-    if task_queue is None or response_queue is None:
-        task_queue, manager = init_servers(
-            number_of_processes=number_of_processes
+    dispatcher = Dispatcher(
+        number_of_processes,
+        task_queue=task_queue,
+        response_queue=response_queue,
+    )
+    rater = Rater(dispatcher, store=store, mode=mode, pack_size=pack_size)
+    pbar = tqdm(
+        total=len(prompts),
+        desc="Rating responses",
+        disable=not display_progress,
+    )
+    for i, (prompt, response) in enumerate(zip(prompts, responses)):
+        pbar.update(len(rater.submit(i, prompt, response)))
+
+    while dispatcher.pending() or rater.flush():
+        _, key, resp = dispatcher.get()
+        pbar.update(len(rater.handle(key, resp)))
+
+    dispatcher.close()
+
+    ratings = [rater.ratings[i] for i, _ in enumerate(prompts)]
+    return ratings[0] if return_single else ratings
+
+
+class TimeoutEstimator:
+    """
+    Learns request latency from observations and sets per-request timeouts.
+
+    Latency is modeled per model as a linear function of prompt and
+    completion tokens, fitted on the most recent successful requests. The
+    timeout is the prediction scaled by a high quantile of the observed to
+    predicted latency ratio and by a safety margin, clamped to
+    [`min_timeout`, `max_timeout`]. Until a model has enough observations,
+    the caller's timeout is used.
+
+    Args:
+        quantile (float, optional): Quantile of the latency ratio used for the timeout. Defaults to 0.95.
+        min_observations (int, optional): Observations needed before estimating. Defaults to 10.
+        history (int, optional): Number of recent observations kept per model. Defaults to 500.
+        min_timeout (float, optional): Smallest timeout, in seconds. Defaults to 5.
+        max_timeout (float, optional): Largest timeout, in seconds. Defaults to 600.
+        margin (float, optional): Factor applied to the predicted latency quantile. Defaults to 1.5.
+    """
+
+    def __init__(
+        self,
+        quantile=0.95,
+        min_observations=10,
+        history=500,
+        min_timeout=5,
+        max_timeout=600,
+        margin=1.5,
+    ):
+        self.quantile = quantile
+        self.min_observations = min_observations
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.margin = margin
+        self.observations = collections.defaultdict(
+            lambda: collections.deque(maxlen=history)
+        )
+        self.fits = {}
+
+    @staticmethod
+    def prompt_tokens(message, system_prompt=None):
+        # Rough count, avoids encoding every prompt in the workers
+        return (len(str(message)) + len(str(system_prompt or ""))) / 4
+
+    def observe(self, model, prompt_tokens, completion_tokens, latency):
+        """
+        Record the latency of a successful request.
+        """
+        self.observations[model].append(
+            (prompt_tokens, completion_tokens, latency)
         )
-        response_queue = manager.Queue()
-        self_hosted = True
-    else:
-        self_hosted = False
+        self.fits.pop(model, None)
 
-    rating_prompt = "You are given a prompt and a response, and you provide a grade out of 100 measuring the quality of the response.\nPrompt: {}\n\n###\n\nResponse: {}\n\n###\n\nGrade: "
-    for i, (prompt, response) in enumerate(zip(prompts, responses)):
-        task_queue.put(
-            (
-                i,
-                rating_prompt.format(prompt, response),
-                16,
-                {"temperature": 0, "model": "mistralai/Mixtral-8x7B-Instruct-v0.1", "timeout": 30},
-                response_queue,
+    def ready(self, model):
+        """
+        Whether there are enough observations of a model to estimate its timeouts.
+        """
+        return len(self.observations[model]) >= self.min_observations
+
+    def _fit(self, model):
+        if model not in self.fits:
+            obs = np.array(self.observations[model], dtype=np.float64)
+            features = np.column_stack([np.ones(len(obs)), obs[:, :2]])
+            coef = np.linalg.lstsq(features, obs[:, 2], rcond=None)[0]
+            predicted = np.maximum(features @ coef, 1e-3)
+            self.fits[model] = (
+                coef,
+                np.quantile(obs[:, 2] / predicted, self.quantile),
+                np.quantile(obs[:, 1], self.quantile),
+            )
+        return self.fits[model]
+
+    def timeout(self, model, prompt_tokens, max_tokens, default=None):
+        """
+        Timeout for a request.
+
+        Args:
+            model (str): The model queried.
+            prompt_tokens (float): The estimated number of prompt tokens.
+            max_tokens (int): The maximum number of tokens to generate.
+            default (float, optional): The timeout used while there are too few observations.
+
+        Returns:
+            float or None: The timeout in seconds.
+        """
+        if not self.ready(model):
+            return default
+
+        coef, ratio, completion_tokens = self._fit(model)
+        predicted = coef @ [1, prompt_tokens, min(max_tokens, completion_tokens)]
+        return float(
+            np.clip(
+                max(predicted, 0) * ratio * self.margin,
+                self.min_timeout,
+                self.max_timeout,
             )
         )
 
-    ratings = [0 for _ in prompts]
-    for _ in tqdm(
-        prompts,
-        total=len(prompts),
-        desc="Rating responses",
-        disable=not display_progress,
-    ):
-        i, resp = response_queue.get(block=True)
-        try:
-            ratings[i] = float(
-                re.search(
-                    r"[0-9][0-9.]*(/100)?",
-                    resp.choices[0].message.content.strip(),
-                )
-                .group(0)
-                .split("/")[0]
+
+def can_still_match(text, target):
+    """
+    Whether a partial output can still grow into `target`, optionally followed by dots and whitespace.
+
+    This is the streaming counterpart of the success check in perturb_model,
+    which matches the whole output against the target, ignoring case.
+
+    Args:
+        text (str): The output generated so far.
+        target (str): The expected output.
+
+    Returns:
+        bool: False if no continuation of `text` matches the target.
+    """
+    target = target.strip()
+    if re.search(r"[.^$*+?{}\[\]\\|()]", target):
+        # Regular expression targets are only checked on the full output
+        return True
+
+    text = text.lstrip().lower()
+    target = target.lower()
+    if len(text) <= len(target):
+        return target.startswith(text)
+    return (
+        text.startswith(target)
+        and not text[len(target) :].replace(".", "").strip()
+    )
+
+
+def collect_stream(stream, query_type="chat", should_stop=None):
+    """
+    Consume a streamed completion and assemble it into a single response.
+
+    Args:
+        stream: The chunks returned by a create call with stream=True.
+        query_type (str, optional): The type of query, "chat" or "completion". Defaults to "chat".
+        should_stop (Callable[[Dict[int, str]], bool], optional): Called with the text of each choice so far after
+            every chunk. When it returns True, the stream is closed and the response is marked as aborted.
+
+    Returns:
+        SimpleNamespace: A response with the same `choices` layout as a non-streamed one, and with `ttft`,
+            the time to the first generated text in seconds, `latency`, the total time, and `aborted`.
+    """
+    start = time.time()
+    ttft = None
+    texts = collections.defaultdict(list)
+    finish_reasons = {}
+    model, usage = None, None
+    aborted = False
+
+    for chunk in stream:
+        model = getattr(chunk, "model", model)
+        usage = getattr(chunk, "usage", None) or usage
+        for choice in chunk.choices:
+            text = (
+                choice.delta.content if query_type == "chat" else choice.text
             )
-        except AttributeError:
-            ratings[i] = 0
-            # kill_servers()
-            # raise ValueError(
-            #     "Error with rating: response is {}: ".format(
-            #         resp.choices[0].message.content
-            #     )
-            # ) from e
+            if text:
+                if ttft is None:
+                    ttft = time.time() - start
+                texts[choice.index].append(text)
+            if choice.finish_reason is not None:
+                finish_reasons[choice.index] = choice.finish_reason
 
-    if self_hosted:
-        kill_servers()
+        if should_stop is not None and should_stop(
+            {index: "".join(text) for index, text in texts.items()}
+        ):
+            # Closing the stream cancels the rest of the generation
+            if hasattr(stream, "close"):
+                stream.close()
+            aborted = True
+            break
 
-    return ratings[0] if return_single else ratings
+    choices = []
+    for index in sorted(set(texts) | set(finish_reasons) | {0}):
+        text = "".join(texts[index])
+        choices.append(
+            SimpleNamespace(
+                index=index,
+                message=SimpleNamespace(role="assistant", content=text),
+                text=text,
+                finish_reason=finish_reasons.get(index),
+                logprobs=None,
+            )
+        )
+
+    return SimpleNamespace(
+        model=model,
+        choices=choices,
+        usage=usage,
+        ttft=ttft,
+        latency=time.time() - start,
+        aborted=aborted,
+    )
 
 
-def openai_chat_server(call_queue, leader=False):
+def openai_chat_server(call_queue, leader=False, adaptive_timeout=True):
     """
     A function that listens to a call queue for incoming tasks, and processes them using OpenAI's API.
 
@@ -109,12 +644,15 @@ def openai_chat_server(call_queue, leader=False):
         max_tokens: an integer representing the maximum number of tokens to generate.
         kwargs: a dictionary containing optional keyword arguments to be passed to the call_openai function.
         dest_queue: a queue object where the result of the task will be put.
+    leader (bool): Whether this server keeps running when rate limited.
+    adaptive_timeout (bool): Set request timeouts from the latency observed by this server.
 
     Returns:
         None
     """
     client = OpenAI(api_key=TOGETHER_API_KEY,
   base_url='https://api.together.xyz',)
+    estimator = TimeoutEstimator() if adaptive_timeout else None
 
     while True:
         task = call_queue.get(block=True)
@@ -122,7 +660,9 @@ def openai_chat_server(call_queue, leader=False):
             return
 
         compl_id, message, max_tokens, kwargs, dest_queue = task
-        rslt = call_openai(client, message, max_tokens, **kwargs)
+        rslt = call_openai(
+            client, message, max_tokens, estimator=estimator, **kwargs
+        )
         if rslt == 0 and not leader:
             call_queue.put(task)
             print("Reducing the number of OpenAI threads due to Rate Limit")
@@ -147,6 +687,11 @@ def call_openai(
     stop=None,
     timeout=None,
     n=1,
+    top_logprobs=None,
+    estimator=None,
+    stream=False,
+    idle_timeout=None,
+    early_abort_targets=None,
 ):
     """
     Calls the OpenAI API to generate text based on the given parameters.
@@ -165,29 +710,82 @@ def call_openai(
         stop (str, optional): A stop sequence
         timeout (int, optional): The maximum time to wait for a response from the API, in seconds. Defaults to 10.
         n (int, optional): The number of responses to generate. Defaults to 1.
+        top_logprobs (int, optional): Return the log probabilities of this many most likely tokens at each position. Defaults to None.
+        estimator (TimeoutEstimator, optional): Replaces the timeout by one estimated from observed latency, and learns
+            from this request. A request timing out before the caller's timeout is retried with a doubled deadline,
+            up to the caller's timeout, without counting as a failed retry. Defaults to None.
+        stream (bool, optional): Stream the response, see collect_stream. The timeout then applies to the gap between
+            chunks rather than to the whole request. Defaults to False.
+        idle_timeout (int, optional): The longest gap between chunks when streaming, in seconds. Defaults to `timeout`.
+        early_abort_targets (List[str], optional): Stream the response and stop it as soon as every choice has
+            diverged from all of these expected outputs, see can_still_match. Defaults to None.
 
     Returns:
         The generated responses from the OpenAI API.
     """
+    prompt_tokens = TimeoutEstimator.prompt_tokens(message, system_prompt)
+    should_stop = None
+    if early_abort_targets:
+        stream = True
+
+        def should_stop(texts):
+            # The first chunk of a chat stream only carries the role
+            if len(texts) < n or not all(texts.values()):
+                return False
+            return all(
+                not any(can_still_match(t, p) for p in early_abort_targets)
+                for t in texts.values()
+            )
+
+    if stream:
+        # Slow but steady generations are not cut off by a total deadline
+        timeout = idle_timeout if idle_timeout is not None else timeout
+    # Deadline the estimate is doubled up to when it is too tight
+    estimate_cap = None
+    if not stream and estimator is not None and estimator.ready(model):
+        estimate = estimator.timeout(model, prompt_tokens, max_tokens, timeout)
+        estimate_cap = timeout if timeout is not None else estimator.max_timeout
+        if estimate >= estimate_cap:
+            estimate_cap = None
+        timeout = estimate
 
     def loop(f, params):
+        nonlocal estimate_cap
         retry = 0
         while retry < 7:
             try:
-                return f(params)
+                start = time.time()
+                resp = f(params)
+                usage = getattr(resp, "usage", None)
+                if estimator is not None and usage is not None:
+                    estimator.observe(
+                        model,
+                        prompt_tokens,
+                        usage.completion_tokens,
+                        time.time() - start,
+                    )
+                return resp
             except Exception as e:
                 if retry > 5:
                     print(f"Error {retry}: {e}\n{params}")
                 if "maximum context length" in str(e):
                     print("Context length exceeded")
                     return None
+                if "timed out" in str(e) and estimate_cap is not None:
+                    # The learned deadline was too tight for this one, which
+                    # does not count against the worker
+                    params["timeout"] = min(params["timeout"] * 2, estimate_cap)
+                    if params["timeout"] >= estimate_cap:
+                        estimate_cap = None
+                    continue
                 if (
                     "Rate limit" in str(e)
                     or "overloaded" in str(e)
                     or "timed out" in str(e)
                 ):
                     if "timed out" in str(e) and retry < 2:
-                        params["timeout"] += 30 * retry
+                        if params.get("timeout") is not None:
+                            params["timeout"] += 30 * retry
                     elif retry < 1:
                         time.sleep(30 * (1 + retry))
                     else:
@@ -216,6 +814,32 @@ def call_openai(
     if timeout is not None:
         request_params["timeout"] = timeout
 
+    if top_logprobs is not None:
+        if query_type == "chat":
+            request_params["logprobs"] = True
+            request_params["top_logprobs"] = top_logprobs
+        else:
+            request_params["logprobs"] = top_logprobs
+
+    create = (
+        client.chat.completions.create
+        if query_type == "chat"
+        else client.completions.create
+    )
+    if stream:
+        request_params["stream"] = True
+
+        def call(params):
+            params = dict(params)
+            if "timeout" in params:
+                params["timeout"] = Timeout(params["timeout"])
+            return collect_stream(create(**params), query_type, should_stop)
+
+    else:
+
+        def call(params):
+            return create(**params)
+
     if query_type == "chat":
         if system_prompt is not None:
             messages = [
@@ -225,20 +849,19 @@ def call_openai(
         else:
             messages = [{"role": "user", "content": message}]
         request_params["messages"] = messages
-        return loop(
-            lambda x: client.chat.completions.create(**x), request_params
-        )
+        return loop(call, request_params)
 
     request_params["prompt"] = message
-    return loop(lambda x: client.completions.create(**x), request_params)
+    return loop(call, request_params)
 
 
-def init_servers(number_of_processes=4):
+def init_servers(number_of_processes=4, adaptive_timeout=True):
     """
     Initializes multiple chat servers using multiprocessing.
 
     Args:
         number_of_processes (int): The number of server processes to start. Default is 4.
+        adaptive_timeout (bool): Let each server set request timeouts from its observed latency. Default is True.
 
     Returns:
         tuple: A tuple containing a call queue and a global manager object.
@@ -248,7 +871,8 @@ def init_servers(number_of_processes=4):
 
     for i in range(number_of_processes):
         p = multiprocessing.Process(
-            target=openai_chat_server, args=(call_queue, i == 0)
+            target=openai_chat_server,
+            args=(call_queue, i == 0, adaptive_timeout),
         )
         p.start()
         global_process_list.append(p)
@@ -265,6 +889,193 @@ def kill_servers():
         p.join()
 
 
+class Dispatcher:
+    """
+    Shares a single pool of servers between several stages of requests.
+
+    Each request is submitted under a stage name and a key. Stages can be
+    capped to a maximum number of in-flight calls; requests above the cap
+    wait locally and are sent as soon as a call from the same stage returns.
+
+    With a batch size above 1, completion requests with the same model and
+    parameters are held until the next `get` and sent as one multi-prompt
+    call. The choices of a batched call are split back per request.
+
+    Args:
+        parallelism (int): The number of server processes to start. Default is 8.
+        caps (Dict[str, int], optional): Maximum number of in-flight calls per stage.
+        task_queue (multiprocessing.Queue, optional): An existing call queue to use instead of starting servers.
+        response_queue (multiprocessing.Queue, optional): The response queue to use with `task_queue`.
+        batch_size (int, optional): Maximum number of completion prompts per call. Default is 1.
+        batch_token_budget (int, optional): Maximum estimated prompt tokens per batched call. Default is 8192.
+    """
+
+    def __init__(
+        self,
+        parallelism=8,
+        caps=None,
+        task_queue=None,
+        response_queue=None,
+        batch_size=1,
+        batch_token_budget=8192,
+    ):
+        if task_queue is None or response_queue is None:
+            task_queue, manager = init_servers(parallelism)
+            response_queue = manager.Queue()
+            self.self_hosted = True
+        else:
+            self.self_hosted = False
+
+        self.queue = task_queue
+        self.resp_queue = response_queue
+        self.caps = caps if caps is not None else {}
+        self.in_flight = collections.Counter()
+        self.waiting = collections.defaultdict(collections.deque)
+        self.tickets = {}
+        self.next_ticket = 0
+        self.batch_size = batch_size
+        self.batch_token_budget = batch_token_budget
+        self.queued = collections.Counter()
+        self.ready = collections.deque()
+
+    def submit(self, stage, key, message, max_tokens, kwargs):
+        """
+        Queue a request for a stage.
+
+        Args:
+            stage (str): The stage the request belongs to.
+            key: An identifier returned alongside the response.
+            message (str): The prompt.
+            max_tokens (int): The maximum number of tokens to generate.
+            kwargs (dict): Keyword arguments for call_openai.
+        """
+        self.waiting[stage].append((key, message, max_tokens, dict(kwargs)))
+        self.queued[stage] += 1
+        if not self._batchable(kwargs):
+            self._fill(stage)
+
+    def _batchable(self, kwargs):
+        return (
+            self.batch_size > 1
+            and kwargs.get("query_type") == "completion"
+            and not kwargs.get("stream")
+            and not kwargs.get("early_abort_targets")
+        )
+
+    def _take_batch(self, stage):
+        key, message, max_tokens, kwargs = self.waiting[stage].popleft()
+        if not self._batchable(kwargs):
+            return [key], message, max_tokens, kwargs
+
+        signature = (max_tokens, repr(sorted(kwargs.items())))
+        keys, messages = [key], [message]
+        tokens = TimeoutEstimator.prompt_tokens(message)
+        rest = collections.deque()
+        while self.waiting[stage] and len(keys) < self.batch_size:
+            request = self.waiting[stage].popleft()
+            request_tokens = TimeoutEstimator.prompt_tokens(request[1])
+            if (
+                (request[2], repr(sorted(request[3].items()))) != signature
+                or tokens + request_tokens > self.batch_token_budget
+            ):
+                rest.append(request)
+                continue
+            keys.append(request[0])
+            messages.append(request[1])
+            tokens += request_tokens
+        self.waiting[stage].extendleft(reversed(rest))
+
+        if len(keys) == 1:
+            return keys, message, max_tokens, kwargs
+        return keys, messages, max_tokens, kwargs
+
+    def _fill(self, stage):
+        cap = self.caps.get(stage, math.inf)
+        while self.waiting[stage] and self.in_flight[stage] < cap:
+            keys, message, max_tokens, kwargs = self._take_batch(stage)
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.tickets[ticket] = (stage, keys, kwargs.get("n", 1))
+            self.in_flight[stage] += 1
+            self.queue.put(
+                (ticket, message, max_tokens, kwargs, self.resp_queue)
+            )
+
+    @staticmethod
+    def _split(resp, count, n):
+        # Choices of a multi-prompt call are ordered by prompt, n per prompt
+        if resp is None or resp == 0:
+            return [resp for _ in range(count)]
+
+        per_prompt = [[] for _ in range(count)]
+        for choice in resp.choices:
+            per_prompt[choice.index // n].append(
+                SimpleNamespace(
+                    index=choice.index % n,
+                    text=choice.text,
+                    finish_reason=getattr(choice, "finish_reason", None),
+                    logprobs=getattr(choice, "logprobs", None),
+                )
+            )
+        return [
+            SimpleNamespace(
+                model=getattr(resp, "model", None),
+                choices=sorted(choices, key=lambda c: c.index),
+                usage=None,
+            )
+            for choices in per_prompt
+        ]
+
+    def pending(self, stage=None):
+        """
+        Number of requests submitted but not yet returned.
+
+        Args:
+            stage (str, optional): Only count requests from this stage.
+
+        Returns:
+            int: The number of outstanding requests.
+        """
+        stages = [stage] if stage is not None else list(self.queued)
+        return sum(self.queued[s] for s in stages)
+
+    def get(self):
+        """
+        Wait for the next response from any stage.
+
+        Returns:
+            tuple: The stage, key and response of the completed request.
+        """
+        if not self.ready:
+            # Send the completion requests held for batching
+            for stage in list(self.waiting):
+                self._fill(stage)
+
+            ticket, resp = self.resp_queue.get(block=True)
+            stage, keys, n = self.tickets.pop(ticket)
+            self.in_flight[stage] -= 1
+            self._fill(stage)
+
+            if len(keys) == 1:
+                self.ready.append((stage, keys[0], resp))
+            else:
+                for key, key_resp in zip(
+                    keys, self._split(resp, len(keys), n)
+                ):
+                    self.ready.append((stage, key, key_resp))
+
+        stage, key, resp = self.ready.popleft()
+        self.queued[stage] -= 1
+        return stage, key, resp
+
+    def close(self):
+        """
+        Stop the servers if they were started by this dispatcher.
+        """
+        if self.self_hosted:
+            kill_servers()
+
+
 def standalone_server(inputs, **kwargs):
     """
     Run a standalone server to process inputs and return responses.
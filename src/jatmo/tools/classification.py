@@ -0,0 +1,128 @@
+""" Label decoding for classification tasks with a declared label set. """
+import math
+import re
+
+from ..server import first_token_logprobs
+from .tokens import count_tokens
+
+DECODING_MODES = ["text", "logprob"]
+
+
+def normalize_label(text):
+    return re.sub(r"[^\w\s]", "", str(text)).strip().lower()
+
+
+def label_max_tokens(labels, margin=2, encoding="cl100k_base"):
+    """
+    Number of tokens needed to generate the longest label.
+
+    Args:
+        labels (List[str]): The label set.
+        margin (int, optional): Extra tokens for punctuation and whitespace. Defaults to 2.
+        encoding (str, optional): The tiktoken encoding. Defaults to "cl100k_base".
+
+    Returns:
+        int: The max_tokens of a classification request.
+    """
+    return int(count_tokens([" " + l for l in labels], encoding).max()) + margin
+
+
+def classification_kwargs(labels, mode="text", **kwargs):
+    """
+    Keyword arguments for call_openai of a classification request.
+
+    Args:
+        labels (List[str]): The label set.
+        mode (str, optional): The decoding mode, see decode_label. Defaults to "text".
+        **kwargs: Additional keyword arguments for call_openai.
+
+    Returns:
+        dict: The keyword arguments, with top_logprobs set in "logprob" mode.
+    """
+    if mode not in DECODING_MODES:
+        raise ValueError(f"Unknown decoding mode {mode}.")
+    if not labels:
+        raise ValueError("Classification requires a label set.")
+
+    if mode == "logprob":
+        kwargs["top_logprobs"] = 10
+    return kwargs
+
+
+def match_label(text, labels):
+    """
+    Match a generated text to a label, see decode_label.
+
+    Returns:
+        str or None: The label, None if the text matches no label or several.
+    """
+    normalized = normalize_label(text)
+    targets = {normalize_label(l): l for l in labels}
+    if normalized in targets:
+        return targets[normalized]
+
+    # Otherwise accept a single label appearing as a whole word
+    found = {
+        label
+        for target, label in targets.items()
+        if target and re.search(r"\b" + re.escape(target) + r"\b", normalized)
+    }
+    return found.pop() if len(found) == 1 else None
+
+
+def decode_label(resp, labels, query_type="chat", mode="text"):
+    """
+    Decode a label from a response.
+
+    In "text" mode, the generated text is matched to the labels after
+    lowercasing and removing punctuation. In "logprob" mode, the label is
+    the argmax of the first-token probabilities summed over the labels each
+    token starts, falling back to text matching without log probabilities.
+
+    Args:
+        resp: The response returned by the servers.
+        labels (List[str]): The label set.
+        query_type (str, optional): The type of query, "chat" or "completion". Defaults to "chat".
+        mode (str, optional): "text" or "logprob". Defaults to "text".
+
+    Returns:
+        str or None: The label, None if the response matches no label.
+    """
+    if resp is None or resp == 0:
+        return None
+
+    choice = resp.choices[0]
+    if mode == "logprob":
+        logprobs = first_token_logprobs(choice)
+        if logprobs:
+            scores = {}
+            for token, logprob in logprobs.items():
+                token = normalize_label(token)
+                if not token:
+                    continue
+                for label in labels:
+                    if normalize_label(label).startswith(token):
+                        scores[label] = scores.get(label, 0) + math.exp(logprob)
+            if scores:
+                return max(scores, key=scores.get)
+
+    text = choice.message.content if query_type == "chat" else choice.text
+    return match_label(text or "", labels)
+
+
+def accuracy(predictions, references):
+    """
+    Exact-match accuracy, counting undecoded predictions as errors.
+
+    Returns:
+        float: The fraction of predictions equal to their reference.
+    """
+    if len(predictions) != len(references):
+        raise ValueError(
+            "The number of predictions and references must be equal."
+        )
+    if not predictions:
+        return 0.0
+    return sum(
+        p is not None and p == r for p, r in zip(predictions, references)
+    ) / len(predictions)
@@ -1,10 +1,156 @@
+import random
+
 import dill
+from tqdm import tqdm
 
-from ..server import init_servers, kill_servers, rate_completions
+from ..server import Dispatcher, Rater, RatingStore
+from .classification import (
+    accuracy,
+    classification_kwargs,
+    decode_label,
+    label_max_tokens,
+    match_label,
+)
 from .finetune import (
     format_finetune_data,
 )
-from .output_generation import label_inputs
+from .metrics import (
+    bootstrap_intervals,
+    chrf,
+    look_confidence,
+    reference_metrics,
+    sequential_stop,
+    write_metrics,
+)
+from .output_generation import response_text
+
+
+def generation_kwargs(model, **kwargs):
+    """
+    Build the generation parameters for a model under evaluation.
+
+    Args:
+        model (str): The model name. Fine-tuned models are queried as completion models.
+        **kwargs: Additional keyword arguments for call_openai.
+
+    Returns:
+        dict: The keyword arguments for call_openai.
+    """
+    if "ft" in model.lower():
+        kwargs["query_type"] = "completion"
+        kwargs["stop"] = ["###"]
+    else:
+        kwargs["query_type"] = "chat"
+
+    kwargs["model"] = model
+    kwargs["timeout"] = 30
+    return kwargs
+
+
+def eval_labels(
+    path,
+    inputs_per_model,
+    model_list,
+    eval_inputs,
+    outputs_per_model,
+    labels,
+    reference_model=None,
+    references=None,
+    parallelism=8,
+    label_decoding="text",
+    completion_batch_size=1,
+    **kwargs,
+):
+    """
+    Evaluate models on a classification task by exact-match accuracy, without a grader.
+
+    Predictions are generated with just enough tokens for the longest label
+    and decoded to the label set. They are compared to the given references,
+    or else to the reference model's labels.
+
+    Args:
+        path (str): The run directory.
+        inputs_per_model (Dict[str, List[str]]): The inputs for each model.
+        model_list (List[str]): The models to evaluate.
+        eval_inputs (List[str]): The evaluation inputs.
+        outputs_per_model (Dict[str, List[str]]): Already generated outputs per model.
+        labels (List[str]): The label set.
+        reference_model (str, optional): The model whose labels are the references. Defaults to None.
+        references (List[str], optional): The true labels. Defaults to the reference model's labels.
+        parallelism (int, optional): Number of servers. Defaults to 8.
+        label_decoding (str, optional): "text" or "logprob", see decode_label. Defaults to "text".
+        completion_batch_size (int, optional): Number of fine-tuned model prompts sent per call. Defaults to 1.
+        **kwargs: Additional keyword arguments for call_openai.
+
+    Returns:
+        Dict[str, float]: The accuracy of each model, except the reference model without true labels.
+    """
+    if references is None and reference_model not in model_list:
+        raise ValueError("Either references or a reference model is required.")
+
+    predictions = {
+        model: [match_label(o, labels) for o in outputs_per_model[model]]
+        for model in model_list
+        if len(outputs_per_model.get(model, [])) == len(eval_inputs)
+    }
+
+    dispatcher = Dispatcher(parallelism, batch_size=completion_batch_size)
+    max_tokens = label_max_tokens(labels)
+    query_types = {}
+    for model in model_list:
+        if model in predictions:
+            continue
+
+        model_kwargs = classification_kwargs(
+            labels, label_decoding, **generation_kwargs(model, **kwargs)
+        )
+        query_types[model] = model_kwargs["query_type"]
+        inputs = inputs_per_model[model]
+        if "ft" in model.lower():
+            inputs = [
+                f["prompt"]
+                for f in format_finetune_data(inputs, ["None" for _ in inputs])
+            ]
+
+        predictions[model] = [None for _ in eval_inputs]
+        outputs_per_model[model] = ["" for _ in eval_inputs]
+        for i, ipt in enumerate(inputs):
+            dispatcher.submit(
+                "generate", (model, i), ipt, max_tokens, model_kwargs
+            )
+
+    pbar = tqdm(total=dispatcher.pending(), desc="Generating labels")
+    while dispatcher.pending():
+        _, (model, i), resp = dispatcher.get()
+        outputs_per_model[model][i] = response_text(resp, query_types[model])
+        predictions[model][i] = decode_label(
+            resp, labels, query_types[model], label_decoding
+        )
+        pbar.update(1)
+    dispatcher.close()
+    pbar.close()
+
+    if references is None:
+        references = predictions[reference_model]
+        evaluated = [m for m in model_list if m != reference_model]
+    else:
+        evaluated = list(model_list)
+
+    with open(path + "/eval_outputs.pkl", "wb") as outfile:
+        dill.dump((eval_inputs, inputs_per_model, outputs_per_model), outfile)
+
+    with open(path + "/eval_ratings.tsv", "w", encoding="utf-8") as outfile:
+        outfile.write("index\treference\t" + "\t".join(evaluated) + "\n")
+        for i, reference in enumerate(references):
+            outfile.write(
+                f"{i}\t{reference}\t"
+                + "\t".join(
+                    str(int(predictions[m][i] == reference)) for m in evaluated
+                )
+                + "\n"
+            )
+
+    return {m: accuracy(predictions[m], references) for m in evaluated}
 
 
 def eval_model(
@@ -14,8 +160,68 @@ def eval_model(
     eval_inputs,
     outputs_per_model=None,
     parallelism=8,
+    grading_mode="text",
+    rating_pack_size=1,
+    reference_model=None,
+    triage_threshold=None,
+    sequential=False,
+    batch_size=10,
+    ci_width=None,
+    confidence=0.95,
+    min_samples=20,
+    seed=0,
+    completion_batch_size=1,
+    labels=None,
+    label_decoding="text",
     **kwargs,
 ):
+    """
+    Generate missing outputs for each model and rate them.
+
+    When a reference model is given, reference-based metrics of every other
+    model against its outputs are written to eval_metrics.tsv. With a triage
+    threshold, outputs whose chrF agreement with the reference output reaches
+    the threshold are not sent to the grader and reuse the reference rating.
+
+    In sequential mode, inputs are rated in randomized mini-batches. After
+    each batch, paired bootstrap intervals are computed on each model's mean
+    and on its gap to the reference model. Evaluation stops once every
+    interval is narrower than `ci_width`, or once no gap interval contains
+    zero. Since the intervals are checked after every batch, each look uses
+    the confidence level corrected for the maximum number of looks, see
+    look_confidence, and so do the returned intervals. Only the rated inputs
+    are written to eval_ratings.tsv.
+
+    With a label set, models are instead scored by exact-match accuracy
+    against the reference model's labels, see eval_labels.
+
+    Args:
+        path (str): The run directory.
+        inputs_per_model (Dict[str, List[str]]): The inputs for each model.
+        model_list (List[str]): The models to evaluate.
+        eval_inputs (List[str]): The inputs shown to the grader.
+        outputs_per_model (Dict[str, List[str]], optional): Already generated outputs per model.
+        parallelism (int, optional): Number of servers. Defaults to 8.
+        grading_mode (str, optional): The rating mode, see Rater. Defaults to "text".
+        rating_pack_size (int, optional): Number of outputs rated per grader request. Defaults to 1.
+        reference_model (str, optional): The model other models are compared to. Defaults to None.
+        triage_threshold (float, optional): chrF agreement above which the grader is skipped. Defaults to None.
+        sequential (bool, optional): Stop rating early once the comparison is decided. Defaults to False.
+        batch_size (int, optional): Number of inputs per mini-batch in sequential mode. Defaults to 10.
+        ci_width (float, optional): Target interval width in sequential mode. Defaults to None.
+        confidence (float, optional): Overall confidence level of the intervals. Defaults to 0.95.
+        min_samples (int, optional): Number of inputs rated before stopping is considered. Defaults to 20.
+        seed (int, optional): Seed of the input order and of the bootstrap. Defaults to 0.
+        completion_batch_size (int, optional): Number of fine-tuned model prompts sent per call. Defaults to 1.
+        labels (List[str], optional): The label set of a classification task. Defaults to None.
+        label_decoding (str, optional): "text" or "logprob", see decode_label. Defaults to "text".
+        **kwargs: Additional keyword arguments for call_openai.
+
+    Returns:
+        Dict[str, float]: The average rating of each model. In sequential mode, each model maps to a dict
+            with its "mean", "ci", number of rated inputs "n" and "gap_ci" to the reference model. With
+            a label set, the accuracy of each model, see eval_labels.
+    """
     if not all(
         len(i) == len(j) and len(i) == len(eval_inputs)
         for i in inputs_per_model.values()
@@ -33,18 +239,83 @@ def eval_model(
                 "Each model must have the same number of outputs as inputs."
             )
 
+    if labels:
+        return eval_labels(
+            path,
+            inputs_per_model,
+            model_list,
+            eval_inputs,
+            outputs_per_model,
+            labels,
+            reference_model=reference_model,
+            parallelism=parallelism,
+            label_decoding=label_decoding,
+            completion_batch_size=completion_batch_size,
+            **kwargs,
+        )
+
+    # Generate missing outputs and rate every output on a single pool. Each
+    # output is sent for rating as soon as it is generated, unless it was
+    # already rated in this run directory.
+    dispatcher = Dispatcher(parallelism, batch_size=completion_batch_size)
+    rater = Rater(
+        dispatcher,
+        store=RatingStore(path),
+        mode=grading_mode,
+        pack_size=rating_pack_size,
+    )
+    pbar = tqdm(
+        total=len(model_list) * len(eval_inputs), desc="Rating outputs"
+    )
+    query_types = {}
+
+    triage = (
+        triage_threshold is not None
+        and reference_model in model_list
+        and len(model_list) > 1
+    )
+    reference_ready = set()
+    waiting_on_reference = {}
+    triaged = set()
+
+    def rate(model, i):
+        return len(
+            rater.submit(
+                (model, i), eval_inputs[i], outputs_per_model[model][i]
+            )
+        )
+
+    def submit_rating(model, i):
+        if not triage:
+            return rate(model, i)
+
+        if model == reference_model:
+            done = rate(model, i)
+            reference_ready.add(i)
+            for other in waiting_on_reference.pop(i, []):
+                done += submit_rating(other, i)
+            return done
+
+        if i not in reference_ready:
+            waiting_on_reference.setdefault(i, []).append(model)
+            return 0
+
+        agreement = chrf(
+            [outputs_per_model[model][i]],
+            [outputs_per_model[reference_model][i]],
+        )[0]
+        if agreement >= triage_threshold:
+            triaged.add((model, i))
+            return 1
+        return rate(model, i)
+
+    model_inputs, model_kwargs = {}, {}
     for model in model_list:
         if len(outputs_per_model[model]) == len(eval_inputs):
             continue
 
-        if "ft" in model.lower():
-            kwargs["query_type"] = "completion"
-            kwargs["stop"] = ["###"]
-        else:
-            kwargs["query_type"] = "chat"
-
-        kwargs["model"] = model
-        kwargs["timeout"] = 30
+        model_kwargs[model] = generation_kwargs(model, **kwargs)
+        query_types[model] = model_kwargs[model]["query_type"]
 
         inputs = inputs_per_model[model]
         if "ft" in model.lower():
@@ -52,45 +323,122 @@ def eval_model(
                 f["prompt"]
                 for f in format_finetune_data(inputs, ["None" for _ in inputs])
             ]
+        model_inputs[model] = inputs
+        outputs_per_model[model] = ["" for _ in eval_inputs]
 
-        outputs_per_model[model] = label_inputs(
-            inputs,
-            parallelism=parallelism,
-            max_tokens=2048,
-            force=False,
-            **kwargs,
+    order = list(range(len(eval_inputs)))
+    if sequential:
+        random.Random(seed).shuffle(order)
+        batches = [
+            order[start : start + batch_size]
+            for start in range(0, len(order), batch_size)
+        ]
+        # Stopping is considered after each batch reaching min_samples
+        confidence = look_confidence(
+            confidence,
+            sum(
+                min(len(order), start + batch_size) >= min_samples
+                for start in range(0, len(order), batch_size)
+            ),
         )
+    else:
+        batches = [order]
 
-    # Rate completions
-    prompts = []
-    responses = []
+    def get_rating(model, i):
+        return rater.ratings[
+            (reference_model if (model, i) in triaged else model, i)
+        ]
 
-    for model in model_list:
-        prompts += eval_inputs
-        responses += outputs_per_model[model]
+    rated = []
+    for batch in batches:
+        for model in model_list:
+            for i in batch:
+                if model in model_inputs:
+                    dispatcher.submit(
+                        "generate",
+                        (model, i),
+                        model_inputs[model][i],
+                        2048,
+                        model_kwargs[model],
+                    )
+                else:
+                    pbar.update(submit_rating(model, i))
 
-    queue, mgr = init_servers(parallelism)
-    resp_queue = mgr.Queue()
-    ratings = rate_completions(prompts, responses, queue, resp_queue)
-    kill_servers()
+        while dispatcher.pending() or rater.flush():
+            stage, key, resp = dispatcher.get()
+            if stage == "generate":
+                model, i = key
+                outputs_per_model[model][i] = response_text(
+                    resp, query_types[model]
+                )
+                pbar.update(submit_rating(model, i))
+            else:
+                pbar.update(len(rater.handle(key, resp)))
+
+        rated.extend(batch)
+        if not sequential or len(rated) < min_samples:
+            continue
+
+        intervals = bootstrap_intervals(
+            {m: [get_rating(m, i) for i in rated] for m in model_list},
+            reference=reference_model,
+            confidence=confidence,
+            seed=seed,
+        )
+        if sequential_stop(intervals, reference_model, ci_width):
+            break
+
+    dispatcher.close()
+    pbar.close()
+
+    rated.sort()
+    ratings = [get_rating(model, i) for model in model_list for i in rated]
+    if triage:
+        print(
+            f"Triaged {len(triaged)} of {len(model_list) * len(rated)} "
+            f"outputs with chrF >= {triage_threshold}."
+        )
+    if sequential:
+        print(f"Rated {len(rated)} of {len(eval_inputs)} inputs.")
 
     with open(path + "/eval_outputs.pkl", "wb") as outfile:
         dill.dump((eval_inputs, inputs_per_model, outputs_per_model), outfile)
 
+    if reference_model in model_list and len(model_list) > 1:
+        write_metrics(
+            path,
+            {
+                model: reference_metrics(
+                    [outputs_per_model[model][i] for i in rated],
+                    [outputs_per_model[reference_model][i] for i in rated],
+                )
+                for model in model_list
+                if model != reference_model
+            },
+            indices=rated,
+        )
+
     with open(path + "/eval_ratings.tsv", "w", encoding="utf-8") as outfile:
         outfile.write("index\t" + "\t".join(model_list) + "\n")
-        for i, _ in enumerate(eval_inputs):
+        for k, i in enumerate(rated):
             line = (
                 f"{i}\t"
                 + "\t".join(
-                    str(ratings[i + j * len(eval_inputs)])
+                    str(ratings[k + j * len(rated)])
                     for j, _ in enumerate(model_list)
                 )
                 + "\n"
             )
             outfile.write(line)
+
+    if sequential:
+        return bootstrap_intervals(
+            {m: [get_rating(m, i) for i in rated] for m in model_list},
+            reference=reference_model,
+            confidence=confidence,
+            seed=seed,
+        )
     return {
-        m: sum(ratings[j * len(eval_inputs) : (j + 1) * len(eval_inputs)])
-        / len(eval_inputs)
+        m: sum(ratings[j * len(rated) : (j + 1) * len(rated)]) / len(rated)
         for j, m in enumerate(model_list)
     }
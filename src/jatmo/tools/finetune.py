@@ -1,55 +1,241 @@
+import hashlib
 import json
+import os
 import re
 import time
 
-from openai import OpenAI
+from openai import NotFoundError, OpenAI
 
+from .tokens import fit_finetune_data
 from .utils import format_prompt
 
+TERMINAL_STATUSES = ["succeeded", "failed", "cancelled"]
 
-def finetune_model(path, training, validation, **kwargs):
-    # Format data for fine-tuning.
-    training_formatted = format_finetune_data(training[0], training[1])
-    validation_formatted = format_finetune_data(validation[0], validation[1])
 
-    # Save to file
-    with open(path + "/finetune.jsonl", "w", encoding="utf-8") as outfile:
-        for entry in training_formatted:
-            json.dump(entry, outfile)
-            outfile.write("\n")
+def write_finetune_file(filename, inputs, outputs):
+    """
+    Stream fine-tuning data to a JSONL file.
+
+    Args:
+        filename (str): The JSONL file to write.
+        inputs (Iterable[str]): Inputs for the fine-tuned model.
+        outputs (Iterable[str]): Outputs for the fine-tuned model.
+
+    Returns:
+        str: The SHA-256 digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(filename, "w", encoding="utf-8") as outfile:
+        for entry in iter_finetune_data(inputs, outputs):
+            line = json.dumps(entry) + "\n"
+            digest.update(line.encode("utf-8"))
+            outfile.write(line)
+    return digest.hexdigest()
+
+
+def drop_empty_outputs(inputs, outputs):
+    """
+    Remove examples with an empty output, such as inputs the teacher was
+    never asked to label because they did not fit its context.
+
+    Args:
+        inputs (Iterable[str]): Inputs for the fine-tuned model.
+        outputs (Iterable[str]): Outputs for the fine-tuned model.
+
+    Returns:
+        Tuple[List[str], List[str]]: The inputs and outputs with a non-empty output.
+    """
+    kept = [(i, o) for i, o in zip(inputs, outputs) if o and o.strip()]
+    return [i for i, _ in kept], [o for _, o in kept]
+
+
+def upload_finetune_data(
+    path, filename, inputs, outputs, client, manifest="upload_manifest.tsv"
+):
+    """
+    Write fine-tuning data and upload it, unless the same content was uploaded.
+
+    Uploaded files are recorded by content hash in a tab-separated manifest in
+    `path`. A recorded file is reused as long as it still exists on the server.
+
+    Args:
+        path (str): The directory the JSONL file and the manifest are written to.
+        filename (str): The name of the JSONL file.
+        inputs (Iterable[str]): Inputs for the fine-tuned model.
+        outputs (Iterable[str]): Outputs for the fine-tuned model.
+        client (OpenAI): The API client.
+        manifest (str, optional): The name of the manifest file. Defaults to "upload_manifest.tsv".
+
+    Returns:
+        str: The uploaded file id.
+    """
+    digest = write_finetune_file(os.path.join(path, filename), inputs, outputs)
+
+    manifest = os.path.join(path, manifest)
+    uploaded = {}
+    if os.path.exists(manifest):
+        with open(manifest, "r", encoding="utf-8") as infile:
+            for line in infile:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) == 2:
+                    uploaded[fields[0]] = fields[1]
+
+    if digest in uploaded:
+        try:
+            client.files.retrieve(uploaded[digest])
+            return uploaded[digest]
+        except NotFoundError:
+            pass
 
-    with open(path + "/finetune_val.jsonl", "w", encoding="utf-8") as outfile:
-        for entry in validation_formatted:
-            json.dump(entry, outfile)
-            outfile.write("\n")
+    with open(os.path.join(path, filename), "rb") as infile:
+        file_id = client.files.create(file=infile, purpose="fine-tune").id
 
-    # Load data to openai server
-    client = OpenAI()
-    file_id = client.files.create(
-        file=open(path + "/finetune.jsonl", "rb"),
-        purpose="fine-tune",
-    ).id
+    with open(manifest, "a", encoding="utf-8") as outfile:
+        outfile.write(f"{digest}\t{file_id}\n")
+    return file_id
 
-    file_val_id = client.files.create(
-        file=open(path + "/finetune_val.jsonl", "rb"),
-        purpose="fine-tune",
-    ).id
+
+def launch_finetune(
+    path,
+    training,
+    validation,
+    suffix="",
+    client=None,
+    validation_file=None,
+    **kwargs,
+):
+    """
+    Upload fine-tuning data and start a fine-tuning job without waiting for it.
+
+    Args:
+        path (str): The directory the JSONL files are written to.
+        training (Tuple[Iterable[str], Iterable[str]]): Training inputs and outputs.
+        validation (Tuple[Iterable[str], Iterable[str]]): Validation inputs and outputs.
+        suffix (str, optional): Suffix of the JSONL file names, so concurrent jobs do not share files. Defaults to "".
+        client (OpenAI, optional): The API client. Defaults to a new OpenAI client.
+        validation_file (str, optional): Id of an already uploaded validation file, used instead of `validation`.
+        **kwargs: Additional keyword arguments for fine_tuning.jobs.create.
+
+    Returns:
+        str: The fine-tuning job id.
+    """
+    if client is None:
+        client = OpenAI()
+
+    file_id = upload_finetune_data(
+        path, f"finetune{suffix}.jsonl", training[0], training[1], client
+    )
+    if validation_file is None:
+        validation_file = upload_finetune_data(
+            path,
+            f"finetune_val{suffix}.jsonl",
+            validation[0],
+            validation[1],
+            client,
+        )
 
     ft_job = client.fine_tuning.jobs.create(
         training_file=file_id,
-        validation_file=file_val_id,
+        validation_file=validation_file,
         model="davinci-002",
         **kwargs,
     )
+    return ft_job.id
+
+
+def format_event(event):
+    """
+    Render a fine-tuning job event as a progress line.
+
+    Args:
+        event: A fine-tuning job event.
+
+    Returns:
+        str: The progress line.
+    """
+    data = getattr(event, "data", None) or {}
+    if getattr(event, "type", None) == "metrics" and "step" in data:
+        line = f"step {data['step']}"
+        if "total_steps" in data:
+            line += f"/{data['total_steps']}"
+        for name in ["train_loss", "valid_loss", "train_mean_token_accuracy"]:
+            if data.get(name) is not None:
+                line += f", {name} {data[name]:.4f}"
+        return line
+    return event.message
+
+
+def poll_finetune(job_id, client, seen, verbose=True):
+    """
+    Retrieve a fine-tuning job and its events not seen yet.
+
+    Args:
+        job_id (str): The fine-tuning job id.
+        client (OpenAI): The API client.
+        seen (Set[str]): Ids of the events already seen, updated in place.
+        verbose (bool, optional): Print the new events. Defaults to True.
+
+    Returns:
+        Tuple: The job and its new events, oldest first.
+    """
+    ft_job = client.fine_tuning.jobs.retrieve(job_id)
+
+    # Events are listed newest first
+    events = client.fine_tuning.jobs.list_events(
+        fine_tuning_job_id=job_id, limit=100
+    ).data
+    new_events = [e for e in reversed(events) if e.id not in seen]
+    seen.update(e.id for e in new_events)
+    if verbose:
+        for event in new_events:
+            print(f"[{job_id}] {format_event(event)}")
+    return ft_job, new_events
 
-    while client.fine_tuning.jobs.retrieve(ft_job.id).status in [
-        "validating_files",
-        "queued",
-        "running",
-    ]:
-        time.sleep(60)
 
-    ft_job = client.fine_tuning.jobs.retrieve(ft_job.id)
+def wait_finetune(
+    job_id,
+    client=None,
+    sleep=time.sleep,
+    min_interval=2,
+    max_interval=20,
+    backoff=1.5,
+    verbose=True,
+):
+    """
+    Follow a fine-tuning job's events until the job ends.
+
+    The job is polled at `min_interval` while new events keep arriving, and
+    the interval grows by `backoff` up to `max_interval` while it is idle.
+
+    Args:
+        job_id (str): The fine-tuning job id.
+        client (OpenAI, optional): The API client. Defaults to a new OpenAI client.
+        sleep (Callable[[float], None], optional): The sleep function. Defaults to time.sleep.
+        min_interval (float, optional): Shortest polling interval, in seconds. Defaults to 2.
+        max_interval (float, optional): Longest polling interval, in seconds. Defaults to 20.
+        backoff (float, optional): Growth factor of the interval while idle. Defaults to 1.5.
+        verbose (bool, optional): Print events as they arrive. Defaults to True.
+
+    Returns:
+        str: The fine-tuned model id.
+    """
+    if client is None:
+        client = OpenAI()
+
+    seen = set()
+    interval = min_interval
+    while True:
+        ft_job, new_events = poll_finetune(job_id, client, seen, verbose)
+        if ft_job.status in TERMINAL_STATUSES:
+            break
+
+        interval = (
+            min_interval
+            if new_events
+            else min(interval * backoff, max_interval)
+        )
+        sleep(interval)
+
     if ft_job.status != "succeeded":
         raise RuntimeError(ft_job.failure_reason)
 
@@ -57,6 +243,148 @@ def finetune_model(path, training, validation, **kwargs):
         return ft_job.fine_tuned_model
 
 
+def finetune_model(path, training, validation, client=None, **kwargs):
+    return wait_finetune(
+        launch_finetune(path, training, validation, client=client, **kwargs),
+        client=client,
+    )
+
+
+def finetune_models(
+    path,
+    training_sets,
+    validation,
+    client=None,
+    context_budget=None,
+    overflow="trim",
+    sleep=time.sleep,
+    min_interval=2,
+    max_interval=20,
+    backoff=1.5,
+    **kwargs,
+):
+    """
+    Fine-tune one model per training set, with all jobs running concurrently.
+
+    Every job is launched up front, and models are yielded in the order their
+    jobs finish, so callers can record and evaluate each one right away. The
+    jobs are polled in turn from the calling thread, as in wait_finetune:
+    no polling thread is alive while the caller handles a model, and closing
+    the generator stops polling at once, leaving the remaining jobs running
+    remotely. Examples with an empty output are never trained or validated on.
+
+    Args:
+        path (str): The directory the JSONL files are written to.
+        training_sets (Dict[int, Tuple[List[str], List[str]]]): Training inputs and outputs, keyed by
+            training set size.
+        validation (Tuple[List[str], List[str]]): Validation inputs and outputs, shared by all jobs.
+        client (OpenAI, optional): The API client. Defaults to a new OpenAI client.
+        context_budget (int, optional): Maximum number of tokens of an example, checked before upload.
+            Defaults to None.
+        overflow (str, optional): Whether to "trim" or "drop" examples over the budget. Defaults to "trim".
+        sleep (Callable[[float], None], optional): The sleep function. Defaults to time.sleep.
+        min_interval (float, optional): Shortest polling interval, in seconds. Defaults to 2.
+        max_interval (float, optional): Longest polling interval, in seconds. Defaults to 20.
+        backoff (float, optional): Growth factor of the interval while all jobs are idle. Defaults to 1.5.
+        **kwargs: Additional keyword arguments for fine_tuning.jobs.create.
+
+    Yields:
+        Tuple[int, str]: The training set size and the fine-tuned model id.
+
+    Raises:
+        RuntimeError: If any job failed, once all other jobs are done.
+    """
+    if not training_sets:
+        # Every model already exists, nothing to upload
+        return
+
+    if client is None:
+        client = OpenAI()
+
+    training_sets = {
+        size: drop_empty_outputs(*training)
+        for size, training in training_sets.items()
+    }
+    validation = drop_empty_outputs(*validation)
+    for size, (inputs, _) in training_sets.items():
+        if not inputs:
+            raise ValueError(f"Training set {size} has no labeled example.")
+
+    if context_budget is not None:
+        training_sets = {
+            size: fit_finetune_data(*training, context_budget, policy=overflow)
+            for size, training in training_sets.items()
+        }
+        validation = fit_finetune_data(
+            *validation, context_budget, policy=overflow
+        )
+
+    # The validation set is shared, upload it once
+    validation_file = upload_finetune_data(
+        path, "finetune_val.jsonl", validation[0], validation[1], client
+    )
+    job_ids = {
+        size: launch_finetune(
+            path,
+            training,
+            None,
+            suffix=f"_{size}",
+            client=client,
+            validation_file=validation_file,
+            **kwargs,
+        )
+        for size, training in training_sets.items()
+    }
+
+    failures = []
+    seen = {size: set() for size in job_ids}
+    interval = min_interval
+    while job_ids:
+        active = False
+        for size, job_id in list(job_ids.items()):
+            ft_job, new_events = poll_finetune(job_id, client, seen[size])
+            active = active or bool(new_events)
+            if ft_job.status not in TERMINAL_STATUSES:
+                continue
+
+            del job_ids[size]
+            if ft_job.status != "succeeded":
+                failures.append(f"{size}: {ft_job.failure_reason}")
+                continue
+            yield size, ft_job.fine_tuned_model
+
+        if job_ids:
+            interval = (
+                min_interval if active else min(interval * backoff, max_interval)
+            )
+            sleep(interval)
+
+    if failures:
+        raise RuntimeError(
+            "Fine-tuning failed for training set sizes " + "; ".join(failures)
+        )
+
+
+def iter_finetune_data(inputs, outputs):
+    """
+    Lazily format data for fine-tuning.
+
+    Args:
+        inputs (Iterable[str]): Inputs for the fine-tuned model.
+        outputs (Iterable[str]): Outputs for the fine-tuned model.
+
+    Yields:
+        Dict: The prompt and completion of each example.
+    """
+    for inp, out in zip(inputs, outputs):
+        yield {
+            "prompt": format_prompt(inp, model_type="completion"),
+            "completion": " "
+            + re.sub(r"[\s\n\t]*###[\s\n\t]*", "", out.strip())
+            + "###",
+        }
+
+
 def format_finetune_data(inputs, outputs):
     """
     Format data for fine-tuning.
@@ -68,12 +396,4 @@ def format_finetune_data(inputs, outputs):
     Returns:
         List[Dict]: A list of dictionaries containing the inputs and outputs for the fine-tuned model.
     """
-    return [
-        {
-            "prompt": format_prompt(inp, model_type="completion"),
-            "completion": " "
-            + re.sub(r"[\s\n\t]*###[\s\n\t]*", "", outputs[i].strip())
-            + "###",
-        }
-        for i, inp in enumerate(inputs)
-    ]
+    return list(iter_finetune_data(inputs, outputs))
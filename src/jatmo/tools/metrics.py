@@ -0,0 +1,351 @@
+""" Reference-based metrics between model outputs, vectorized over output lists.
+
+All metrics score a pair with no token on either side as 0, so that empty
+outputs (failed generations) never count as agreeing with each other.
+"""
+import re
+import zlib
+from statistics import NormalDist
+
+import numpy as np
+
+METRICS = ["rougeL", "chrF", "f1"]
+
+
+def _tokenize(text):
+    return re.findall(r"\w+", str(text).lower())
+
+
+def _hashed_counts(grams_per_text, n_buckets):
+    counts = np.zeros((len(grams_per_text), n_buckets), dtype=np.int32)
+    rows, cols = [], []
+    for row, grams in enumerate(grams_per_text):
+        rows.extend([row] * len(grams))
+        cols.extend(zlib.crc32(g.encode("utf-8")) % n_buckets for g in grams)
+    np.add.at(
+        counts,
+        (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)),
+        1,
+    )
+    return counts
+
+
+def _overlap(hypotheses, references, n_buckets, chunk_size=256):
+    # Clipped n-gram overlap, in row chunks to bound the count matrices.
+    overlap, hyp_total, ref_total = [], [], []
+    for start in range(0, len(hypotheses), chunk_size):
+        hyp = _hashed_counts(hypotheses[start : start + chunk_size], n_buckets)
+        ref = _hashed_counts(references[start : start + chunk_size], n_buckets)
+        overlap.append(np.minimum(hyp, ref).sum(axis=1))
+        hyp_total.append(hyp.sum(axis=1))
+        ref_total.append(ref.sum(axis=1))
+
+    if not overlap:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    return (
+        np.concatenate(overlap),
+        np.concatenate(hyp_total),
+        np.concatenate(ref_total),
+    )
+
+
+def _f_score(precision, recall, beta=1.0):
+    denominator = beta**2 * precision + recall
+    return np.where(
+        denominator > 0,
+        (1 + beta**2) * precision * recall / np.maximum(denominator, 1e-12),
+        0.0,
+    )
+
+
+def token_f1(hypotheses, references, n_buckets=2**14):
+    """
+    Bag-of-words F1 between each hypothesis and its reference. An empty pair scores 0.
+
+    Returns:
+        np.ndarray: One score in [0, 1] per pair.
+    """
+    overlap, hyp_len, ref_len = _overlap(
+        [_tokenize(h) for h in hypotheses],
+        [_tokenize(r) for r in references],
+        n_buckets,
+    )
+    return np.where(
+        hyp_len + ref_len > 0,
+        2 * overlap / np.maximum(hyp_len + ref_len, 1),
+        0.0,
+    )
+
+
+def chrf(hypotheses, references, max_order=6, beta=2.0, n_buckets=2**14):
+    """
+    Character n-gram F-score (chrF) between each hypothesis and its reference.
+    An empty pair scores 0.
+
+    Returns:
+        np.ndarray: One score in [0, 1] per pair.
+    """
+    hypotheses = [re.sub(r"\s+", "", str(h)) for h in hypotheses]
+    references = [re.sub(r"\s+", "", str(r)) for r in references]
+
+    precisions, recalls = [], []
+    for n in range(1, max_order + 1):
+        overlap, hyp_total, ref_total = _overlap(
+            [[h[i : i + n] for i in range(len(h) - n + 1)] for h in hypotheses],
+            [[r[i : i + n] for i in range(len(r) - n + 1)] for r in references],
+            n_buckets,
+        )
+        precisions.append(overlap / np.maximum(hyp_total, 1))
+        recalls.append(overlap / np.maximum(ref_total, 1))
+
+    return _f_score(
+        np.mean(precisions, axis=0), np.mean(recalls, axis=0), beta=beta
+    )
+
+
+def rouge_l(hypotheses, references, max_length=1024):
+    """
+    ROUGE-L F1 between each hypothesis and its reference.
+
+    The longest common subsequence is computed for all pairs at once, one
+    dynamic programming row at a time. Inputs are truncated to `max_length`
+    tokens. An empty pair scores 0.
+
+    Returns:
+        np.ndarray: One score in [0, 1] per pair.
+    """
+    hyp_tokens = [_tokenize(h)[:max_length] for h in hypotheses]
+    ref_tokens = [_tokenize(r)[:max_length] for r in references]
+
+    vocabulary = {}
+    hyp_len = max([len(t) for t in hyp_tokens] + [1])
+    ref_len = max([len(t) for t in ref_tokens] + [1])
+    hyp_ids = np.full((len(hypotheses), hyp_len), -1, dtype=np.int64)
+    ref_ids = np.full((len(references), ref_len), -2, dtype=np.int64)
+    for row, tokens in enumerate(hyp_tokens):
+        hyp_ids[row, : len(tokens)] = [
+            vocabulary.setdefault(t, len(vocabulary)) for t in tokens
+        ]
+    for row, tokens in enumerate(ref_tokens):
+        ref_ids[row, : len(tokens)] = [
+            vocabulary.setdefault(t, len(vocabulary)) for t in tokens
+        ]
+
+    # lcs[:, j] is the LCS length of the hypothesis prefix and ref[:j]. With
+    # a match, prev[j-1] + 1 dominates the other candidates, so each row is a
+    # running maximum.
+    lcs = np.zeros((len(hypotheses), ref_len + 1), dtype=np.int32)
+    for i in range(hyp_len):
+        match = hyp_ids[:, i : i + 1] == ref_ids
+        candidates = np.maximum(lcs[:, 1:], np.where(match, lcs[:, :-1] + 1, 0))
+        lcs[:, 1:] = np.maximum.accumulate(candidates, axis=1)
+
+    lengths = lcs[:, -1]
+    hyp_counts = np.array([len(t) for t in hyp_tokens])
+    ref_counts = np.array([len(t) for t in ref_tokens])
+    return _f_score(
+        lengths / np.maximum(hyp_counts, 1), lengths / np.maximum(ref_counts, 1)
+    )
+
+
+def reference_metrics(hypotheses, references):
+    """
+    Compute all reference-based metrics.
+
+    Args:
+        hypotheses (List[str]): The outputs to score.
+        references (List[str]): The reference outputs, in the same order.
+
+    Returns:
+        Dict[str, np.ndarray]: Scores in [0, 1] per pair, keyed by metric name.
+    """
+    if len(hypotheses) != len(references):
+        raise ValueError(
+            "The number of hypotheses and references must be equal."
+        )
+
+    return {
+        "rougeL": rouge_l(hypotheses, references),
+        "chrF": chrf(hypotheses, references),
+        "f1": token_f1(hypotheses, references),
+    }
+
+
+def write_metrics(
+    path, metrics_per_model, filename="eval_metrics.tsv", indices=None
+):
+    """
+    Write per-input metrics to a tab-separated file.
+
+    Args:
+        path (str): The output directory.
+        metrics_per_model (Dict[str, Dict[str, np.ndarray]]): Metrics per model, as returned by reference_metrics.
+        filename (str, optional): The output file name. Defaults to "eval_metrics.tsv".
+        indices (List[int], optional): The input index of each row. Defaults to 0, 1, ...
+    """
+    columns = [
+        (model, metric) for model in metrics_per_model for metric in METRICS
+    ]
+    count = len(next(iter(metrics_per_model.values()))["f1"]) if columns else 0
+    if indices is None:
+        indices = list(range(count))
+    with open(path + "/" + filename, "w", encoding="utf-8") as outfile:
+        outfile.write(
+            "index\t"
+            + "\t".join(f"{m}:{metric}" for m, metric in columns)
+            + "\n"
+        )
+        for row, index in enumerate(indices):
+            outfile.write(
+                f"{index}\t"
+                + "\t".join(
+                    f"{metrics_per_model[m][metric][row]:.4f}"
+                    for m, metric in columns
+                )
+                + "\n"
+            )
+
+
+def bootstrap_intervals(
+    ratings, reference=None, confidence=0.95, n_resamples=2000, seed=0
+):
+    """
+    Paired bootstrap confidence intervals on mean ratings.
+
+    All models are resampled with the same input indices, so the interval on
+    the gap to the reference model accounts for the per-input correlation.
+
+    Args:
+        ratings (Dict[str, List[float]]): Ratings per model, aligned by input.
+        reference (str, optional): The model gaps are measured against. Defaults to None.
+        confidence (float, optional): The confidence level. Defaults to 0.95.
+        n_resamples (int, optional): Number of bootstrap resamples. Defaults to 2000.
+        seed (int, optional): Seed of the resampling. Defaults to 0.
+
+    Returns:
+        Dict[str, dict]: For each model, the "mean", its "ci", the number of ratings "n",
+            and the "gap_ci" of the model minus the reference (None for the reference).
+    """
+    models = list(ratings)
+    matrix = np.array([ratings[m] for m in models], dtype=np.float64)
+    count = matrix.shape[1]
+    if count == 0:
+        raise ValueError("At least one rating per model is required.")
+
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, count, size=(n_resamples, count))
+    means = matrix[:, samples].mean(axis=2)
+
+    tail = (1 - confidence) / 2 * 100
+
+    def interval(values):
+        low, high = np.percentile(values, [tail, 100 - tail])
+        return (float(low), float(high))
+
+    ref = models.index(reference) if reference in ratings else None
+    return {
+        m: {
+            "mean": float(matrix[j].mean()),
+            "ci": interval(means[j]),
+            "n": count,
+            "gap_ci": (
+                interval(means[j] - means[ref])
+                if ref is not None and j != ref
+                else None
+            ),
+        }
+        for j, m in enumerate(models)
+    }
+
+
+def wilson_intervals(successes, trials, confidence=0.95):
+    """
+    Wilson score intervals of success rates, elementwise.
+
+    Args:
+        successes (np.ndarray): Number of successes.
+        trials (np.ndarray): Number of trials.
+        confidence (float, optional): The confidence level. Defaults to 0.95.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The lower and upper bounds, (0, 1) without trials.
+    """
+    successes = np.asarray(successes, dtype=np.float64)
+    trials = np.asarray(trials, dtype=np.float64)
+
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    safe_trials = np.maximum(trials, 1)
+    rate = successes / safe_trials
+    denominator = 1 + z**2 / safe_trials
+    center = (rate + z**2 / (2 * safe_trials)) / denominator
+    margin = (
+        z
+        * np.sqrt(rate * (1 - rate) / safe_trials + z**2 / (4 * safe_trials**2))
+        / denominator
+    )
+    return (
+        np.where(trials > 0, np.maximum(center - margin, 0.0), 0.0),
+        np.where(trials > 0, np.minimum(center + margin, 1.0), 1.0),
+    )
+
+
+def wilson_interval(successes, trials, confidence=0.95):
+    """
+    Wilson score interval of a success rate.
+
+    Args:
+        successes (int): Number of successes.
+        trials (int): Number of trials.
+        confidence (float, optional): The confidence level. Defaults to 0.95.
+
+    Returns:
+        Tuple[float, float]: The lower and upper bounds, (0, 1) without trials.
+    """
+    low, high = wilson_intervals(successes, trials, confidence)
+    return (float(low), float(high))
+
+
+def look_confidence(confidence, looks):
+    """
+    Per-look confidence level of a test repeated at several interim looks.
+
+    Spends the error rate 1 - `confidence` evenly over the looks (Bonferroni),
+    so that stopping at the first decisive look keeps the overall error rate
+    below 1 - `confidence`, however the looks are correlated.
+
+    Args:
+        confidence (float): The overall confidence level.
+        looks (int): The maximum number of looks.
+
+    Returns:
+        float: The confidence level of each look.
+    """
+    return 1 - (1 - confidence) / max(looks, 1)
+
+
+def sequential_stop(intervals, reference=None, ci_width=None):
+    """
+    Stopping rule of sequential evaluation.
+
+    Args:
+        intervals (Dict[str, dict]): The intervals, as returned by bootstrap_intervals.
+        reference (str, optional): The model gaps are measured against. Defaults to None.
+        ci_width (float, optional): Target interval width. Defaults to None.
+
+    Returns:
+        bool: True once every interval is narrower than `ci_width`, or once no
+            gap interval to the reference contains zero.
+    """
+    narrow = ci_width is not None and all(
+        v["ci"][1] - v["ci"][0] <= ci_width for v in intervals.values()
+    )
+    decided = (
+        len(intervals) > 1
+        and reference in intervals
+        and all(
+            v["gap_ci"][0] > 0 or v["gap_ci"][1] < 0
+            for m, v in intervals.items()
+            if m != reference
+        )
+    )
+    return narrow or decided
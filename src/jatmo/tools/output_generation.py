@@ -4,19 +4,85 @@ import math
 from tqdm import tqdm
 
 from ..server import init_servers, kill_servers
+from .classification import (
+    classification_kwargs,
+    decode_label,
+    label_max_tokens,
+)
+from .tokens import completion_budgets
+
+
+def response_text(resp, query_type="chat"):
+    """
+    Extract the generated text from a response.
+
+    Args:
+        resp: The response returned by the servers.
+        query_type (str, optional): The type of query, "chat" or "completion". Defaults to "chat".
+
+    Returns:
+        str: The first non-empty choice, stripped, or "" if the request failed or all choices are empty.
+    """
+    if resp is None or resp == 0:
+        return ""
+
+    for choice in resp.choices:
+        content = (
+            choice.message.content if query_type == "chat" else choice.text
+        ) or ""
+        if content.strip():
+            return content.strip()
+    return ""
+
+
+def should_resample(resp, text, force):
+    """
+    Whether an empty response should be requested again with several choices.
+
+    Args:
+        resp: The response returned by the servers.
+        text (str): The text extracted from the response.
+        force (bool): Rerun generation if output is empty.
+
+    Returns:
+        bool: True if the request should be resent with n=10.
+    """
+    return (
+        force
+        and text == ""
+        and resp is not None
+        and resp != 0
+        and len(resp.choices) == 1
+    )
 
 
 def label_inputs(
-    inputs, parallelism=8, max_tokens=math.inf, force=False, **kwargs
+    inputs,
+    parallelism=8,
+    max_tokens=math.inf,
+    force=False,
+    context_budget=None,
+    labels=None,
+    label_decoding="text",
+    **kwargs,
 ):
     """
     Generate outputs for a given list of inputs.
 
+    With a label set, only enough tokens for the longest label are
+    generated, and each output is decoded to one of the labels. Outputs
+    matching no label are kept as generated.
+
     Args:
         inputs (list): List of input strings.
         parallelism (int, optional): Number of parallel processes to use. Defaults to 8.
         max_tokens (int, optional): Maximum number of tokens to generate. Defaults to math.inf.
         force (bool, optional): Rerun generation if output is empty. Defaults to False.
+        context_budget (int, optional): Context size of the model. Each request's max_tokens is set to the
+            context left by its prompt, and prompts that leave no room are not sent and get an empty output,
+            which finetune_models drops. Defaults to None.
+        labels (List[str], optional): The label set of a classification task. Defaults to None.
+        label_decoding (str, optional): "text" or "logprob", see decode_label. Defaults to "text".
         **kwargs: Additional keyword arguments.
 
     Returns:
@@ -39,51 +105,58 @@ def label_inputs(
             "label_inputs only supports generating one output at a time."
         )
 
-    for i, inp in enumerate(inputs):
-        queue.put((i, inp, max_tokens, kwargs, resp_queue))
+    if labels:
+        kwargs = classification_kwargs(labels, label_decoding, **kwargs)
+        max_tokens = min(max_tokens, label_max_tokens(labels))
+
+    if context_budget is None:
+        request_max_tokens = [max_tokens for _ in inputs]
+    else:
+        request_max_tokens = completion_budgets(
+            inputs,
+            context_budget,
+            max_tokens=max_tokens,
+            system_prompt=kwargs.get("system_prompt"),
+        )
 
     pbar = tqdm(total=len(inputs), desc=f"Generating {kwargs['model']} outputs")
     done = set()
 
+    for i, inp in enumerate(inputs):
+        if request_max_tokens[i] == 0:
+            # The prompt alone fills the context
+            done.add(i)
+            pbar.update(1)
+            continue
+        queue.put((i, inp, request_max_tokens[i], kwargs, resp_queue))
+
+    query_type = kwargs["query_type"] if "query_type" in kwargs else "chat"
+
     while len(done) != len(inputs):
         for _ in range(len(inputs) - len(done)):
             idx, resp = resp_queue.get(block=True)
-            if resp is None or resp == 0:
-                pbar.update(1)
-                done.add(idx)
-                continue
-
-            if len(resp.choices) == 1:
+            candidate = response_text(resp, query_type)
+            if labels:
                 candidate = (
-                    resp.choices[0].message.content
-                    if "query_type" not in kwargs
-                    or kwargs["query_type"] == "chat"
-                    else resp.choices[0].text
-                ).strip()
-                if candidate == "" and force:
-                    local_kwargs = kwargs.copy()
-                    local_kwargs["n"] = 10
-                    queue.put(
-                        (idx, inputs[idx], max_tokens, local_kwargs, resp_queue)
+                    decode_label(resp, labels, query_type, label_decoding)
+                    or candidate
+                )
+            if should_resample(resp, candidate, force):
+                local_kwargs = kwargs.copy()
+                local_kwargs["n"] = 10
+                queue.put(
+                    (
+                        idx,
+                        inputs[idx],
+                        request_max_tokens[idx],
+                        local_kwargs,
+                        resp_queue,
                     )
-                else:
-                    pbar.update(1)
-                    done.add(idx)
-                    outputs[idx] = candidate
+                )
             else:
-                for choice in resp.choices:
-                    content = (
-                        choice.message.content
-                        if "query_type" not in kwargs
-                        or kwargs["query_type"] == "chat"
-                        else choice.text
-                    ).strip()
-                    if content == "":
-                        continue
-                    outputs[idx] = content
-                    break
                 pbar.update(1)
                 done.add(idx)
+                outputs[idx] = candidate
 
     kill_servers()
     return outputs
@@ -0,0 +1,91 @@
+""" Diverse subset selection of inputs before labeling. """
+import re
+import zlib
+
+import numpy as np
+
+
+def hashed_ngram_vectors(texts, n_features=2**12, ngram_range=(1, 2)):
+    """
+    Embed texts as L2-normalized TF-IDF vectors of hashed word n-grams.
+
+    Args:
+        texts (List[str]): The texts to embed.
+        n_features (int, optional): Number of hash buckets. Defaults to 2**12.
+        ngram_range (Tuple[int, int], optional): Smallest and largest n-gram size. Defaults to (1, 2).
+
+    Returns:
+        np.ndarray: A (len(texts), n_features) float32 matrix.
+    """
+    rows, cols = [], []
+    for row, text in enumerate(texts):
+        words = re.findall(r"\w+", str(text).lower())
+        for n in range(ngram_range[0], ngram_range[1] + 1):
+            for i in range(len(words) - n + 1):
+                rows.append(row)
+                cols.append(
+                    zlib.crc32(" ".join(words[i : i + n]).encode("utf-8"))
+                    % n_features
+                )
+
+    counts = np.zeros((len(texts), n_features), dtype=np.float32)
+    np.add.at(
+        counts,
+        (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)),
+        1,
+    )
+
+    document_frequency = np.count_nonzero(counts, axis=0)
+    idf = np.log((1 + len(texts)) / (1 + document_frequency)) + 1
+    vectors = np.log1p(counts) * idf.astype(np.float32)
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def k_center_greedy(vectors, k, first=0):
+    """
+    Greedy farthest-point (k-center) selection under cosine distance.
+
+    Every prefix of the returned order is itself a greedy k-center solution,
+    so a single selection serves several subset sizes.
+
+    Args:
+        vectors (np.ndarray): L2-normalized row vectors.
+        k (int): Number of points to select.
+        first (int, optional): Index of the first selected point. Defaults to 0.
+
+    Returns:
+        List[int]: The selected indices, in selection order.
+    """
+    k = min(k, len(vectors))
+    if k <= 0:
+        return []
+
+    selected = [first]
+    distances = 1 - vectors @ vectors[first]
+    distances[first] = -np.inf
+    for _ in range(k - 1):
+        idx = int(np.argmax(distances))
+        selected.append(idx)
+        distances = np.minimum(distances, 1 - vectors @ vectors[idx])
+        distances[idx] = -np.inf
+
+    return selected
+
+
+def select_diverse_subset(texts, k, **kwargs):
+    """
+    Pick a maximally diverse subset of texts.
+
+    Args:
+        texts (List[str]): The candidate texts.
+        k (int): The size of the subset.
+        **kwargs: Additional keyword arguments for hashed_ngram_vectors.
+
+    Returns:
+        List[int]: Indices of the selected texts, in selection order.
+    """
+    if k >= len(texts):
+        return list(range(len(texts)))
+    return k_center_greedy(hashed_ngram_vectors(texts, **kwargs), k)
@@ -0,0 +1,170 @@
+""" Token-length pre-flight checks before uploading or sending prompts. """
+import math
+
+import numpy as np
+import tiktoken
+
+from .utils import format_prompt
+
+# Tokens added by the chat template around each message
+CHAT_OVERHEAD = 8
+
+
+def count_tokens(texts, encoding="cl100k_base", num_threads=8):
+    """
+    Count tokens of many texts at once.
+
+    Args:
+        texts (List[str]): The texts to encode.
+        encoding (str, optional): The tiktoken encoding. Defaults to "cl100k_base".
+        num_threads (int, optional): Number of encoder threads. Defaults to 8.
+
+    Returns:
+        np.ndarray: The number of tokens of each text.
+    """
+    encoder = tiktoken.get_encoding(encoding)
+    return np.array(
+        [
+            len(t)
+            for t in encoder.encode_batch(
+                [str(t) for t in texts],
+                num_threads=num_threads,
+                disallowed_special=(),
+            )
+        ],
+        dtype=np.int64,
+    )
+
+
+def report_token_lengths(lengths, name, budget=None):
+    """
+    Print a histogram of token lengths with power-of-two buckets.
+
+    Args:
+        lengths (np.ndarray): The token lengths.
+        name (str): What the lengths are counted on.
+        budget (int, optional): The context budget, to report how many are over it. Defaults to None.
+    """
+    if not len(lengths):
+        return
+
+    top = max(int(lengths.max()), 1)
+    edges = [0] + [2**k for k in range(4, math.ceil(math.log2(top)) + 1)]
+    if edges[-1] < top + 1:
+        edges.append(top + 1)
+    counts, _ = np.histogram(lengths, bins=edges)
+
+    print(
+        f"Token lengths of {len(lengths)} {name}: "
+        f"mean {lengths.mean():.0f}, max {lengths.max()}"
+    )
+    for low, high, count in zip(edges[:-1], edges[1:], counts):
+        if count:
+            print(f"  {low:>6}-{high - 1:<6} {count}")
+    if budget is not None:
+        print(f"  {int((lengths > budget).sum())} over the budget of {budget}")
+
+
+def fit_finetune_data(
+    inputs, outputs, context_budget, policy="trim", encoding="cl100k_base"
+):
+    """
+    Make fine-tuning examples fit in a context budget.
+
+    Examples whose prompt and completion exceed the budget are either dropped,
+    or have the end of their input cut off. Examples whose completion alone
+    does not fit are always dropped.
+
+    Args:
+        inputs (List[str]): Inputs for the fine-tuned model.
+        outputs (List[str]): Outputs for the fine-tuned model.
+        context_budget (int): Maximum number of tokens of an example.
+        policy (str, optional): "trim" or "drop". Defaults to "trim".
+        encoding (str, optional): The tiktoken encoding. Defaults to "cl100k_base".
+
+    Returns:
+        Tuple[List[str], List[str]]: The inputs and outputs that fit.
+    """
+    if policy not in ["trim", "drop"]:
+        raise ValueError(f"Unknown policy {policy}.")
+
+    inputs, outputs = list(inputs), list(outputs)
+    prompt_lengths = count_tokens(
+        format_prompt(inputs, model_type="completion"), encoding
+    )
+    completion_lengths = count_tokens(
+        [" " + o + "###" for o in outputs], encoding
+    )
+    lengths = prompt_lengths + completion_lengths
+    report_token_lengths(lengths, "fine-tuning examples", context_budget)
+
+    if (lengths <= context_budget).all():
+        return inputs, outputs
+
+    encoder = tiktoken.get_encoding(encoding)
+    fitted_inputs, fitted_outputs = [], []
+    for i in range(len(inputs)):
+        if lengths[i] <= context_budget:
+            fitted_inputs.append(inputs[i])
+            fitted_outputs.append(outputs[i])
+            continue
+        if policy == "drop":
+            continue
+
+        # The prompt adds a few tokens around the input itself
+        input_budget = (
+            context_budget
+            - completion_lengths[i]
+            - prompt_lengths[i]
+            + len(encoder.encode(inputs[i].strip(), disallowed_special=()))
+        )
+        if input_budget <= 0:
+            continue
+        fitted_inputs.append(
+            encoder.decode(
+                encoder.encode(inputs[i].strip(), disallowed_special=())[
+                    :input_budget
+                ]
+            )
+        )
+        fitted_outputs.append(outputs[i])
+
+    print(
+        f"Kept {len(fitted_inputs)} of {len(inputs)} examples "
+        f"({policy} policy, budget of {context_budget} tokens)."
+    )
+    return fitted_inputs, fitted_outputs
+
+
+def completion_budgets(
+    prompts,
+    context_budget,
+    max_tokens=math.inf,
+    system_prompt=None,
+    encoding="cl100k_base",
+    report=True,
+):
+    """
+    Per-request max_tokens that fit each prompt's remaining context.
+
+    Args:
+        prompts (List[str]): The prompts to send.
+        context_budget (int): Maximum number of prompt and completion tokens.
+        max_tokens (int, optional): Upper bound on max_tokens. Defaults to math.inf.
+        system_prompt (str, optional): The system prompt sent with every prompt. Defaults to None.
+        encoding (str, optional): The tiktoken encoding. Defaults to "cl100k_base".
+        report (bool, optional): Print a histogram of the prompt lengths. Defaults to True.
+
+    Returns:
+        List[int]: The max_tokens of each request, 0 if the prompt leaves no room.
+    """
+    lengths = count_tokens(prompts, encoding) + CHAT_OVERHEAD
+    if system_prompt is not None:
+        lengths += count_tokens([system_prompt], encoding)[0] + CHAT_OVERHEAD
+    if report:
+        report_token_lengths(lengths, "prompts", context_budget)
+
+    return [
+        int(min(max_tokens, max(context_budget - length, 0)))
+        for length in lengths
+    ]
@@ -33,12 +33,45 @@ class ConfigSpec:
     )
     models: List[str] = field(default_factory=list, hash=False)
     no_formatting: bool = False
+    local_formatting: bool = False
+    streaming: bool = False
+    stage_caps: Dict[str, int] = field(default_factory=dict, hash=False)
+    coreset_selection: bool = False
+    coreset_oversample: float = 2.0
+    grading_mode: str = "text"
+    rating_pack_size: int = 1
+    triage_threshold: Optional[float] = None
+    sequential_eval: bool = False
+    eval_batch_size: int = 10
+    eval_ci_width: Optional[float] = None
+    label_context_budget: Optional[int] = None
+    finetune_context_budget: Optional[int] = None
+    context_overflow: str = "trim"
+    stream_labels: bool = False
+    early_abort_injections: bool = False
+    completion_batch_size: int = 1
+    full_injection_grid: bool = False
+    task_type: str = "generation"
+    class_labels: List[str] = field(default_factory=list, hash=False)
+    label_decoding: str = "text"
     prompt_injections: List[str] = field(default_factory=list, hash=False)
 
     @staticmethod
     def from_dict(d: Dict[str, Any]) -> ConfigSpec:
         return dacite.from_dict(ConfigSpec, d)
 
+    def classification_labels(self):
+        """
+        The label set of a classification task, None for generation tasks.
+        """
+        if self.task_type == "generation":
+            return None
+        if self.task_type != "classification":
+            raise ValueError(f"Unknown task type {self.task_type}.")
+        if not self.class_labels:
+            raise ValueError("Classification tasks require class_labels.")
+        return self.class_labels
+
     def set_prompt_injections(self, prompts, expected_responses):
         if len(prompts) != len(expected_responses):
             raise ValueError(
@@ -0,0 +1,65 @@
+import queue
+from types import SimpleNamespace
+
+import pytest
+
+
+def chat_response(text, logprobs=None):
+    return SimpleNamespace(
+        choices=[
+            SimpleNamespace(
+                index=0,
+                text=text,
+                message=SimpleNamespace(content=text),
+                logprobs=logprobs,
+                finish_reason="stop",
+            )
+        ],
+        usage=None,
+    )
+
+
+class FakeTaskQueue:
+    """
+    Stands in for the server pool: answers each task as soon as it is queued.
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.tasks = []
+
+    def put(self, task):
+        self.tasks.append(task)
+        task_id, message, max_tokens, kwargs, dest_queue = task
+        dest_queue.put((task_id, self.respond(message, max_tokens, kwargs)))
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    """
+    Replace init_servers and kill_servers of the given modules by a fake pool.
+
+    Returns a function taking the modules and a respond(message, max_tokens,
+    kwargs) callback, and returning the fake task queue.
+    """
+
+    def install(modules, respond):
+        task_queue = FakeTaskQueue(respond)
+        for module in modules:
+            monkeypatch.setattr(
+                module,
+                "init_servers",
+                lambda *args, **kwargs: (
+                    task_queue,
+                    SimpleNamespace(Queue=queue.Queue),
+                ),
+            )
+            monkeypatch.setattr(module, "kill_servers", lambda: None)
+        return task_queue
+
+    return install
+
+
+@pytest.fixture
+def respond_chat():
+    return chat_response
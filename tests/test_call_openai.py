@@ -0,0 +1,170 @@
+from types import SimpleNamespace
+
+from jatmo import server
+
+
+class FakeCompletions:
+    """
+    Records the parameters of each create call and replays scripted results.
+    """
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = []
+
+    def create(self, **params):
+        self.calls.append(params)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def fake_client(results):
+    completions = FakeCompletions(results)
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+
+def trained_estimator(latency=0.1):
+    estimator = server.TimeoutEstimator(min_timeout=1)
+    for k in range(20):
+        estimator.observe("model", k, (7 * k) % 11, latency)
+    return estimator
+
+
+def test_timeout_retry_without_timeout():
+    client = fake_client([Exception("Request timed out."), "response"])
+
+    assert (
+        server.call_openai(
+            client, "prompt", 5, model="model", estimator=trained_estimator()
+        )
+        is not None
+    )
+    assert "timeout" in client.chat.completions.calls[0]
+
+    client = fake_client([Exception("Request timed out."), "response"])
+    assert server.call_openai(client, "prompt", 5, model="model") == "response"
+    assert all("timeout" not in c for c in client.chat.completions.calls)
+
+
+def test_estimate_replaces_longer_caller_timeout():
+    client = fake_client(["response"])
+    server.call_openai(
+        client,
+        "prompt",
+        5,
+        model="model",
+        timeout=30,
+        estimator=trained_estimator(),
+    )
+    assert client.chat.completions.calls[0]["timeout"] < 30
+
+    client = fake_client(["response"])
+    server.call_openai(
+        client,
+        "prompt",
+        5,
+        model="model",
+        timeout=30,
+        estimator=trained_estimator(latency=60),
+    )
+    assert 60 < client.chat.completions.calls[0]["timeout"] <= 600
+
+
+def test_estimate_timeouts_double_the_deadline_without_failing():
+    timed_out = Exception("Request timed out.")
+    client = fake_client([timed_out] * 4 + ["response"])
+
+    assert (
+        server.call_openai(
+            client,
+            "prompt",
+            5,
+            model="model",
+            timeout=30,
+            estimator=trained_estimator(),
+        )
+        == "response"
+    )
+    # Doubled up to the caller's timeout, then retried as usual
+    assert [c["timeout"] for c in client.chat.completions.calls] == [
+        1,
+        2,
+        4,
+        8,
+        16,
+    ]
+
+    client = fake_client([timed_out] * 10)
+    assert (
+        server.call_openai(
+            client,
+            "prompt",
+            5,
+            model="model",
+            timeout=4,
+            estimator=trained_estimator(),
+        )
+        == 0
+    )
+    assert [c["timeout"] for c in client.chat.completions.calls] == [
+        1,
+        2,
+        4,
+        4,
+        34,
+    ]
+
+
+def chat_chunk(content, finish_reason=None, role=None):
+    return SimpleNamespace(
+        model="model",
+        usage=None,
+        choices=[
+            SimpleNamespace(
+                index=0,
+                delta=SimpleNamespace(role=role, content=content),
+                finish_reason=finish_reason,
+            )
+        ],
+    )
+
+
+def test_early_abort_skips_role_only_first_chunk():
+    chunks = [
+        chat_chunk(None, role="assistant"),
+        chat_chunk("Access"),
+        chat_chunk(" granted"),
+        chat_chunk(".", finish_reason="stop"),
+    ]
+    client = fake_client([iter(chunks)])
+
+    resp = server.call_openai(
+        client,
+        "prompt",
+        8,
+        model="model",
+        early_abort_targets=["Access granted"],
+    )
+    assert not resp.aborted
+    assert resp.choices[0].message.content == "Access granted."
+
+
+def test_early_abort_stops_diverging_stream():
+    chunks = [
+        chat_chunk(None, role="assistant"),
+        chat_chunk("Sorry"),
+        chat_chunk(", I cannot"),
+    ]
+    client = fake_client([iter(chunks)])
+
+    resp = server.call_openai(
+        client,
+        "prompt",
+        8,
+        model="model",
+        early_abort_targets=["Access granted"],
+    )
+    assert resp.aborted
+    assert resp.choices[0].message.content == "Sorry"
@@ -0,0 +1,49 @@
+import numpy as np
+
+from jatmo import server
+from jatmo.automatic_pipeline.eval_model import compare_to_ft_model
+from jatmo.tools import classification
+
+
+def test_classification_is_scored_by_accuracy_without_grader(
+    fake_pool, respond_chat, monkeypatch, tmp_path
+):
+    monkeypatch.setattr(
+        classification,
+        "count_tokens",
+        lambda texts, encoding=None: np.array([1 for _ in texts]),
+    )
+    reviews = ["A great movie", "A dull movie", "A fine movie", "A bad movie"]
+
+    def respond(message, max_tokens, kwargs):
+        if kwargs.get("query_type") != "completion":
+            # The teacher calls every review positive
+            return respond_chat(" Positive.")
+        return respond_chat("positive" if "great" in message else "negative")
+
+    task_queue = fake_pool([server], respond)
+    results = compare_to_ft_model(
+        str(tmp_path),
+        reviews,
+        None,
+        ["ft:model"],
+        "Classify the review.",
+        no_formatting=True,
+        temperatures=[0.0],
+        labels=["positive", "negative"],
+    )
+
+    assert results == {0.0: {"ft:model": 0.25}}
+    assert len(task_queue.tasks) == 2 * len(reviews)
+    assert {t[2] for t in task_queue.tasks} == {
+        classification.label_max_tokens(["positive", "negative"])
+    }
+    assert not (tmp_path / "rating_store.tsv").exists()
+    lines = (tmp_path / "eval_ratings_0.0.tsv").read_text().splitlines()
+    assert lines[0] == "index\treference\tft:model"
+    assert lines[1:] == [
+        "0\tpositive\t1",
+        "1\tpositive\t0",
+        "2\tpositive\t0",
+        "3\tpositive\t0",
+    ]
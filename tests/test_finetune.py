@@ -0,0 +1,186 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from jatmo.tools import finetune
+
+
+class FakeJobs:
+    """
+    Fine-tuning jobs walking through a scripted list of statuses, one per poll.
+    """
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.polls = {job_id: 0 for job_id in statuses}
+        self.created = []
+
+    def create(self, **kwargs):
+        job_id = f"job-{len(self.created)}"
+        self.created.append(kwargs)
+        return SimpleNamespace(id=job_id)
+
+    def retrieve(self, job_id):
+        statuses = self.statuses[job_id]
+        status = statuses[min(self.polls[job_id], len(statuses) - 1)]
+        self.polls[job_id] += 1
+        return SimpleNamespace(
+            status=status,
+            fine_tuned_model=f"ft:{job_id}" if status == "succeeded" else None,
+            failure_reason="bad data" if status == "failed" else None,
+        )
+
+    def list_events(self, fine_tuning_job_id, limit):
+        polls = self.polls[fine_tuning_job_id]
+        # One new event per status change, newest first
+        statuses = self.statuses[fine_tuning_job_id][:polls]
+        changes = [
+            i for i, s in enumerate(statuses) if i == 0 or s != statuses[i - 1]
+        ]
+        return SimpleNamespace(
+            data=[
+                SimpleNamespace(
+                    id=f"{fine_tuning_job_id}-{i}", message=statuses[i]
+                )
+                for i in reversed(changes)
+            ]
+        )
+
+
+def fake_client(statuses):
+    files = SimpleNamespace(
+        create=lambda file, purpose: SimpleNamespace(id=f"file-{file.name}"),
+        retrieve=lambda file_id: None,
+    )
+    return SimpleNamespace(
+        files=files, fine_tuning=SimpleNamespace(jobs=FakeJobs(statuses))
+    )
+
+
+def test_finetune_models_yields_in_completion_order_without_threads(tmp_path):
+    client = fake_client(
+        {
+            "job-0": ["running"] * 4 + ["succeeded"],
+            "job-1": ["running", "succeeded"],
+            "job-2": ["running", "failed"],
+        }
+    )
+    training_sets = {size: (["input"], ["output"]) for size in [10, 20, 30]}
+    threads = threading.active_count()
+
+    results = []
+    models = finetune.finetune_models(
+        str(tmp_path),
+        training_sets,
+        (["input"], ["output"]),
+        client=client,
+        sleep=lambda _: None,
+    )
+    with pytest.raises(RuntimeError, match="30: bad data"):
+        for size, model_id in models:
+            assert threading.active_count() == threads
+            results.append((size, model_id))
+
+    assert results == [(20, "ft:job-1"), (10, "ft:job-0")]
+
+
+def test_finetune_models_stops_polling_when_closed(tmp_path):
+    client = fake_client(
+        {"job-0": ["running", "succeeded"], "job-1": ["running"] * 1000}
+    )
+    models = finetune.finetune_models(
+        str(tmp_path),
+        {10: (["input"], ["output"]), 20: (["input"], ["output"])},
+        (["input"], ["output"]),
+        client=client,
+        sleep=lambda _: None,
+    )
+    assert next(models) == (10, "ft:job-0")
+    models.close()
+    assert client.fine_tuning.jobs.polls["job-1"] == 1
+
+
+def test_wait_finetune_returns_model_on_success(capsys):
+    client = fake_client(
+        {"job-0": ["validating_files", "queued", "running", "succeeded"]}
+    )
+    sleeps = []
+
+    assert (
+        finetune.wait_finetune("job-0", client=client, sleep=sleeps.append)
+        == "ft:job-0"
+    )
+    # Stops at the first terminal status, each change is a new event
+    assert client.fine_tuning.jobs.polls["job-0"] == 4
+    assert sleeps == [2, 2, 2]
+    assert capsys.readouterr().out.splitlines() == [
+        "[job-0] validating_files",
+        "[job-0] queued",
+        "[job-0] running",
+        "[job-0] succeeded",
+    ]
+
+
+@pytest.mark.parametrize("status", ["failed", "cancelled"])
+def test_wait_finetune_raises_on_failure(status):
+    client = fake_client({"job-0": ["queued", "running", status]})
+
+    with pytest.raises(RuntimeError):
+        finetune.wait_finetune(
+            "job-0", client=client, sleep=lambda _: None, verbose=False
+        )
+    assert client.fine_tuning.jobs.polls["job-0"] == 3
+
+
+def test_wait_finetune_backs_off_while_idle_and_caps_interval():
+    client = fake_client(
+        {
+            "job-0": ["queued"]
+            + ["running"] * 5
+            + ["evaluating"] * 2
+            + ["succeeded"]
+        }
+    )
+    sleeps = []
+
+    finetune.wait_finetune(
+        "job-0",
+        client=client,
+        sleep=sleeps.append,
+        min_interval=1,
+        max_interval=5,
+        backoff=2,
+        verbose=False,
+    )
+    # New events reset the interval, idle polls double it up to the cap
+    assert sleeps == [1, 1, 2, 4, 5, 5, 1, 2]
+
+
+def test_finetune_models_never_trains_on_empty_outputs(tmp_path):
+    client = fake_client({"job-0": ["succeeded"]})
+    models = finetune.finetune_models(
+        str(tmp_path),
+        {3: (["first", "second", "third"], ["one", "", "  "])},
+        (["fourth", "fifth"], ["", "five"]),
+        client=client,
+    )
+
+    assert list(models) == [(3, "ft:job-0")]
+    assert (tmp_path / "finetune_3.jsonl").read_text().count("\n") == 1
+    assert (tmp_path / "finetune_val.jsonl").read_text().count("\n") == 1
+
+
+def test_finetune_models_without_training_sets_makes_no_call(
+    tmp_path, monkeypatch
+):
+    def no_client():
+        raise AssertionError("No client should be created.")
+
+    monkeypatch.setattr(finetune, "OpenAI", no_client)
+    monkeypatch.setattr(finetune, "upload_finetune_data", no_client)
+
+    assert list(
+        finetune.finetune_models(str(tmp_path), {}, (["input"], ["output"]))
+    ) == []
+    assert list(tmp_path.iterdir()) == []
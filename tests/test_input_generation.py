@@ -0,0 +1,38 @@
+import re
+
+from jatmo.automatic_pipeline import input_generation
+
+
+def test_format_inputs_collects_llm_fallback(
+    fake_pool, tmp_path, monkeypatch, respond_chat
+):
+    monkeypatch.chdir(tmp_path)
+
+    def respond(message, max_tokens, kwargs):
+        raw = re.search(
+            r"Original Input:\s*START(.*)END", message, re.S
+        ).group(1)
+        paragraphs = [p.strip() for p in raw.split("\n\n") if p.strip()]
+        return respond_chat("START" + "\n###\n".join(paragraphs) + "END")
+
+    task_queue = fake_pool([input_generation], respond)
+
+    # Two-field inputs are formatted locally once the layout is inferred,
+    # three-field ones do not match it and fall back to the LLM.
+    inputs = [f"question {k}\n\ncontext {k}" for k in range(8)] + [
+        f"question {k}\n\nextra {k} context\n\nmore" for k in range(8, 12)
+    ]
+    gpt_inputs, ft_inputs, _ = input_generation.format_inputs(
+        "Answer the question.",
+        inputs,
+        examples=["q ### c"],
+        local_formatting=True,
+        calibration_size=5,
+    )
+
+    assert all(ft_inputs)
+    assert len(task_queue.tasks) == 5 + 4
+    for k in range(8, 12):
+        assert f"extra {k} context" in ft_inputs[k]
+        assert gpt_inputs[k].startswith("Answer the question. ###")
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from jatmo.tools.metrics import (
+    METRICS,
+    bootstrap_intervals,
+    look_confidence,
+    reference_metrics,
+    sequential_stop,
+)
+
+
+@pytest.mark.parametrize(
+    "hypothesis, reference",
+    [("", ""), ("   ", ""), ("!!", "?"), ("", "some text"), ("some text", "")],
+)
+def test_empty_pairs_score_zero_for_every_metric(hypothesis, reference):
+    scores = reference_metrics([hypothesis], [reference])
+    assert {metric: float(scores[metric][0]) for metric in METRICS} == {
+        metric: 0.0 for metric in METRICS
+    }
+
+
+def test_identical_outputs_score_one_for_every_metric():
+    scores = reference_metrics(["the cat sat down"], ["the cat sat down"])
+    for metric in METRICS:
+        assert np.isclose(scores[metric][0], 1.0)
+
+
+def test_look_confidence_spends_error_over_looks():
+    assert np.isclose(look_confidence(0.95, 1), 0.95)
+    assert np.isclose(look_confidence(0.95, 5), 0.99)
+    assert np.isclose(look_confidence(0.95, 0), 0.95)
+
+
+def test_sequential_stop_on_decided_gap_or_narrow_intervals():
+    intervals = {
+        "ref": {"mean": 5.0, "ci": (4.0, 6.0), "n": 20, "gap_ci": None},
+        "ft": {"mean": 7.0, "ci": (6.5, 7.5), "n": 20, "gap_ci": (1.0, 3.0)},
+    }
+    assert sequential_stop(intervals, "ref")
+    assert not sequential_stop(intervals, None)
+    assert sequential_stop(intervals, None, ci_width=2.0)
+    assert not sequential_stop(intervals, None, ci_width=1.0)
+
+    intervals["ft"]["gap_ci"] = (-0.5, 3.0)
+    assert not sequential_stop(intervals, "ref")
+
+
+def test_corrected_looks_keep_false_stops_near_alpha():
+    # Two models with the same rating distribution: any decided stop is a
+    # false positive. Checking at every look with the uncorrected level stops
+    # far more often than 1 - confidence.
+    rng = np.random.default_rng(0)
+    runs, looks, min_samples, batch_size = 100, 5, 20, 10
+    false_stops = {"naive": 0, "corrected": 0}
+    for run in range(runs):
+        ratings = rng.integers(1, 11, size=(2, min_samples + looks * batch_size))
+        for name, confidence in [
+            ("naive", 0.9),
+            ("corrected", look_confidence(0.9, looks)),
+        ]:
+            for look in range(looks):
+                count = min_samples + look * batch_size
+                intervals = bootstrap_intervals(
+                    {"ref": ratings[0, :count], "ft": ratings[1, :count]},
+                    reference="ref",
+                    confidence=confidence,
+                    seed=run,
+                )
+                if sequential_stop(intervals, "ref"):
+                    false_stops[name] += 1
+                    break
+
+    assert false_stops["corrected"] <= 0.15 * runs
+    assert false_stops["naive"] >= 2 * false_stops["corrected"]
@@ -0,0 +1,53 @@
+import string
+
+import numpy as np
+
+from jatmo import server
+from jatmo.automatic_pipeline import streaming
+from jatmo.tools import tokens
+
+
+def test_stream_synthetic_dataset_never_labels_empty_inputs(
+    fake_pool, respond_chat, monkeypatch
+):
+    monkeypatch.setattr(
+        tokens,
+        "count_tokens",
+        lambda texts, encoding=None: np.array([len(t.split()) for t in texts]),
+    )
+    topics = iter(string.ascii_lowercase)
+    format_calls = {}
+
+    def respond(message, max_tokens, kwargs):
+        if kwargs.get("temperature") == 1.0:
+            return respond_chat(f"Article about {next(topics)}")
+        if kwargs.get("temperature") == 0:
+            topic = message.split("Article about ")[-1][0]
+            calls = format_calls[topic] = format_calls.get(topic, 0) + 1
+            if topic == "c" or (topic == "b" and calls == 1):
+                # Failed format, retried and then dropped for "c"
+                return None
+            return respond_chat(f"START Text: Article about {topic} END")
+        return respond_chat("Summary")
+
+    task_queue = fake_pool([server], respond)
+    inputs, (gpt_inputs, _, _), labels = streaming.stream_synthetic_dataset(
+        "Summarize the article.",
+        6,
+        examples=["Text: an example article"],
+        label_context_budget=100,
+        stream_labels=True,
+    )
+
+    label_tasks = [t for t in task_queue.tasks if t[3].get("stream")]
+    assert len(inputs) == 6
+    assert all(message for _, message, _, _, _ in label_tasks)
+    assert all(0 < max_tokens < 100 for _, _, max_tokens, _, _ in label_tasks)
+    assert format_calls["b"] == 2
+    assert format_calls["c"] == 1 + streaming.FORMAT_RETRIES
+
+    dropped = [i for i, text in enumerate(inputs) if text.endswith("about c")]
+    assert [gpt_inputs[i] for i in dropped] == [""]
+    assert [labels[i] for i in dropped] == [""]
+    assert sum(label == "Summary" for label in labels) == 5
+    assert len(label_tasks) == 5